@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
-import os
+import time
+from typing import Callable, Optional, Set
 
 import aws_cdk as cdk
 
@@ -9,47 +10,95 @@ from cdk.data_stack import DataStack
 from cdk.compute_stack import ComputeStack
 from cdk.util import settings, Props
 
-app = cdk.App()
-# CdkStack(
-#     app,
-#     "CdkStack",
-#     # If you don't specify 'env', this stack will be environment-agnostic.
-#     # Account/Region-dependent features and context lookups will not work,
-#     # but a single synthesized template can be deployed anywhere.
-#     # Uncomment the next line to specialize this stack for the AWS Account
-#     # and Region that are implied by the current CLI configuration.
-#     # env=cdk.Environment(account=os.getenv('CDK_DEFAULT_ACCOUNT'), region=os.getenv('CDK_DEFAULT_REGION')),
-#     # Uncomment the next line if you know exactly what Account and Region you
-#     # want to deploy the stack to. */
-#     # env=cdk.Environment(account='123456789012', region='us-east-1'),
-#     # For more information, see https://docs.aws.amazon.com/cdk/latest/guide/environments.html
-# )
-
-props = Props()
-env = cdk.Environment(account=settings.CDK_DEFAULT_ACCOUNT, region=settings.REGION)
-
-dns_stack = DnsStack(app, f"{settings.PROJECT_NAME}-dns-stack", env=env)
-props.network_hosted_zone = dns_stack.hosted_zone
-
-network_stack = NetworkStack(
-    app, f"{settings.PROJECT_NAME}-network-stack", props, env=env
-)
-props.network_vpc = network_stack.vpc
-props.network_backend_certificate = network_stack.backend_certificate
-props.network_frontend_certificate = network_stack.frontend_certificate
-
-data_stack = DataStack(app, f"{settings.PROJECT_NAME}-data-stack", props, env=env)
-props.data_aurora_db = data_stack.aurora_db
-props.data_s3_public_images = data_stack.s3_public_images
-props.data_s3_private_images = data_stack.s3_private_images
-props.data_cloudfront_public_images = data_stack.cloudfront_public_images
-props.data_cloudfront_private_images = data_stack.cloudfront_private_images
-
-compute_stack = ComputeStack(
-    app, f"{settings.PROJECT_NAME}-compute-stack", props, env=env
-)
-
-data_stack.add_dependency(network_stack)
-compute_stack.add_dependency(data_stack)
-
-app.synth()
+# Each stack consumes Props filled in by the stacks it depends on, so selecting
+# a stack always constructs its dependencies too
+STACK_DEPENDENCIES = {
+    "dns": [],
+    "network": ["dns"],
+    "data": ["network"],
+    "compute": ["data"],
+}
+
+
+def selected_stacks(app: cdk.App) -> Set[str]:
+    """Stacks named in the "stacks" context (`cdk synth -c stacks=data`), plus
+    their dependencies; all stacks when the context is not set."""
+    requested = app.node.try_get_context("stacks")
+    if not requested:
+        return set(STACK_DEPENDENCIES)
+
+    selected: Set[str] = set()
+    pending = [name.strip() for name in requested.split(",")]
+    while pending:
+        name = pending.pop()
+        if name not in STACK_DEPENDENCIES:
+            raise ValueError(
+                f"Unknown stack {name!r}, expected one of {list(STACK_DEPENDENCIES)}"
+            )
+        if name not in selected:
+            selected.add(name)
+            pending.extend(STACK_DEPENDENCIES[name])
+    return selected
+
+
+def build(
+    app: cdk.App,
+    stacks: Set[str],
+    on_stack: Optional[Callable[[str, float], None]] = None,
+) -> None:
+    props = Props()
+    env = cdk.Environment(account=settings.CDK_DEFAULT_ACCOUNT, region=settings.REGION)
+
+    def report(name: str, start: float) -> None:
+        if on_stack is not None:
+            on_stack(name, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    dns_stack = DnsStack(app, f"{settings.PROJECT_NAME}-dns-stack", env=env)
+    props.network_hosted_zone = dns_stack.hosted_zone
+    report("dns", start)
+
+    if "network" not in stacks:
+        return
+
+    start = time.perf_counter()
+    network_stack = NetworkStack(
+        app, f"{settings.PROJECT_NAME}-network-stack", props, env=env
+    )
+    props.network_vpc = network_stack.vpc
+    props.network_backend_certificate = network_stack.backend_certificate
+    props.network_frontend_certificate = network_stack.frontend_certificate
+    report("network", start)
+
+    if "data" not in stacks:
+        return
+
+    start = time.perf_counter()
+    data_stack = DataStack(app, f"{settings.PROJECT_NAME}-data-stack", props, env=env)
+    props.data_aurora_db = data_stack.aurora_db
+    props.data_db_proxy = data_stack.db_proxy
+    props.data_s3_public_images = data_stack.s3_public_images
+    props.data_s3_private_images = data_stack.s3_private_images
+    props.data_cloudfront_public_images = data_stack.cloudfront_public_images
+    props.data_cloudfront_private_images = data_stack.cloudfront_private_images
+    props.data_manifest_queue = data_stack.manifest_queue
+
+    data_stack.add_dependency(network_stack)
+    report("data", start)
+
+    if "compute" not in stacks:
+        return
+
+    start = time.perf_counter()
+    compute_stack = ComputeStack(
+        app, f"{settings.PROJECT_NAME}-compute-stack", props, env=env
+    )
+
+    compute_stack.add_dependency(data_stack)
+    report("compute", start)
+
+
+if __name__ == "__main__":
+    app = cdk.App()
+    build(app, selected_stacks(app))
+    app.synth()
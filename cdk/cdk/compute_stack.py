@@ -1,6 +1,9 @@
 import json
+import re
 from aws_cdk import (
+    CustomResource,
     Stack,
+    Stage,
     Duration,
     aws_cloudfront as cloudfront,
     aws_cloudfront_origins as cloudfront_origins,
@@ -9,6 +12,7 @@ from aws_cdk import (
     aws_ecs as ecs,
     aws_ecs_patterns as ecs_patterns,
     aws_elasticloadbalancingv2 as elbv2,
+    aws_lambda as lambda_,
     aws_logs as logs,
     aws_route53 as r53,
     aws_route53_targets as r53_targets,
@@ -16,12 +20,21 @@ from aws_cdk import (
     aws_s3_deployment as s3_deployment,
     aws_secretsmanager as secretsmanager,
     aws_ecr as ecr,
-    aws_iam as iam
+    aws_iam as iam,
+    custom_resources,
 )
 from constructs import Construct
 
+from cdk.frontend_assets import (
+    PRECOMPRESSED_CONTENT_TYPES,
+    asset_keys,
+    precompress_assets,
+)
 from cdk.util import settings, Props
 
+# Added by the API cache bypass function to authenticated requests
+API_CACHE_BYPASS_QUERY_STRING = "_nocache"
+
 
 class ComputeStack(Stack):
     def __init__(
@@ -52,11 +65,16 @@ class ComputeStack(Stack):
         fargate_task_definition = ecs.FargateTaskDefinition(
             self,
             f"{settings.PROJECT_NAME}-fargate-task-definition",
-            cpu=512,
-            memory_limit_mib=2048,
+            cpu=settings.profile.fargate_cpu,
+            memory_limit_mib=settings.profile.fargate_memory_mib,
+            # The backend image is pushed for both architectures
             runtime_platform=ecs.RuntimePlatform(
                 operating_system_family=ecs.OperatingSystemFamily.LINUX,
-                cpu_architecture = ecs.CpuArchitecture.ARM64
+                cpu_architecture=(
+                    ecs.CpuArchitecture.ARM64
+                    if settings.profile.architecture == "arm64"
+                    else ecs.CpuArchitecture.X86_64
+                ),
             ),
 
         )
@@ -65,6 +83,7 @@ class ComputeStack(Stack):
         app_secret_key.grant_write(fargate_task_definition.task_role)
         props.data_s3_public_images.grant_read_write(fargate_task_definition.task_role)
         props.data_s3_private_images.grant_read_write(fargate_task_definition.task_role)
+        props.data_manifest_queue.grant_consume_messages(fargate_task_definition.task_role)
 
         # Granting task definition access to Datadog API key
         datadog_api_key.grant_write(fargate_task_definition.task_role)
@@ -84,7 +103,12 @@ class ComputeStack(Stack):
             repository_name="cs40:latest"
         )
 
-        fargate_task_definition.add_container(
+        # Empty task-scoped volume holding the agent's APM and DogStatsD sockets
+        datadog_socket_volume = "datadog-sockets"
+        datadog_socket_dir = "/var/run/datadog"
+        fargate_task_definition.add_volume(name=datadog_socket_volume)
+
+        app_container = fargate_task_definition.add_container(
             f"{settings.PROJECT_NAME}-app-container",
             container_name=f"{settings.PROJECT_NAME}-app-container",
             logging=ecs.AwsLogDriver(
@@ -106,11 +130,21 @@ class ComputeStack(Stack):
             environment={
                 "PRODUCTION": "true",
                 "DEBUG": "false",
+                "POSTGRES_HOST": props.data_db_proxy.endpoint,
                 "FORWARD_FACING_NAME": f"{settings.PROJECT_NAME}.{settings.SUNET}.{settings.COURSE_DNS_ROOT}",
                 "PUBLIC_IMAGES_BUCKET": f"{props.data_s3_public_images.bucket_name}",
                 "PRIVATE_IMAGES_BUCKET": f"{props.data_s3_private_images.bucket_name}",
                 "PUBLIC_IMAGES_CLOUDFRONT_DISTRIBUTION": f"{props.data_cloudfront_public_images.domain_name}",
                 "PRIVATE_IMAGES_CLOUDFRONT_DISTRIBUTION": f"{props.data_cloudfront_private_images.domain_name}",
+                "IMAGE_MANIFEST_QUEUE_URL": props.data_manifest_queue.queue_url,
+                "DD_TRACE_AGENT_URL": f"unix://{datadog_socket_dir}/apm.socket",
+                "DD_DOGSTATSD_URL": f"unix://{datadog_socket_dir}/dsd.socket",
+                "DD_TRACE_SAMPLE_RATE": str(settings.DATADOG_TRACE_SAMPLE_RATE),
+                "DD_TRACE_RATE_LIMIT": str(settings.DATADOG_TRACE_RATE_LIMIT),
+                "DD_PROFILING_ENABLED": str(settings.DATADOG_PROFILING_ENABLED).lower(),
+                "DD_RUNTIME_METRICS_ENABLED": str(settings.DATADOG_RUNTIME_METRICS_ENABLED).lower(),
+                # Not read by ddtrace itself; passed to the app's DogStatsd client
+                "STATSD_FLUSH_INTERVAL_SECONDS": str(settings.DATADOG_STATSD_FLUSH_INTERVAL_SECONDS),
             },
             secrets=secrets,
             docker_labels={
@@ -124,16 +158,20 @@ class ComputeStack(Stack):
         datadog_secrets = {}
         datadog_secrets["DD_API_KEY"] = ecs.Secret.from_secrets_manager(datadog_api_key)
 
-        fargate_task_definition.add_container(
+        datadog_container = fargate_task_definition.add_container(
             f"{settings.PROJECT_NAME}-datadog-sidecar-container",
             image=ecs.ContainerImage.from_registry("public.ecr.aws/datadog/agent:latest"),
+            cpu=settings.DATADOG_AGENT_CPU,
+            memory_reservation_mib=settings.DATADOG_AGENT_MEMORY_RESERVATION_MIB,
+            memory_limit_mib=settings.DATADOG_AGENT_MEMORY_LIMIT_MIB,
             environment={
                 "ECS_FARGATE": "true",
                 "ECS_FARGATE_METRICS": "true",
                 "DD_SITE": "us5.datadoghq.com",
                 "DD_APM_ENABLED": "true",
-                "DD_PROFILING_ENABLED": "true",
-                "DD_APM_NON_LOCAL_TRAFFIC": "true"
+                "DD_APM_RECEIVER_SOCKET": f"{datadog_socket_dir}/apm.socket",
+                "DD_DOGSTATSD_SOCKET": f"{datadog_socket_dir}/dsd.socket",
+                "DD_APM_MAX_TPS": str(settings.DATADOG_APM_MAX_TPS),
             },
             secrets=datadog_secrets,
             logging=ecs.AwsLogDriver(
@@ -147,13 +185,23 @@ class ComputeStack(Stack):
                 interval=Duration.seconds(30),
                 start_period=Duration.seconds(15)
             ),
-            port_mappings=[
-                ecs.PortMapping(
-                    container_port=8126,
-                    host_port=8126
-                )
-            ],
+        )
 
+        for container in [app_container, datadog_container]:
+            container.add_mount_points(
+                ecs.MountPoint(
+                    source_volume=datadog_socket_volume,
+                    container_path=datadog_socket_dir,
+                    read_only=False,
+                )
+            )
+        # Start the agent first so its sockets are in place when the tracer
+        # first connects; not HEALTHY, so an agent problem can't keep the app down
+        app_container.add_container_dependencies(
+            ecs.ContainerDependency(
+                container=datadog_container,
+                condition=ecs.ContainerDependencyCondition.START,
+            )
         )
 
         # FILLMEIN: Finish the Fargate service backend deployment
@@ -165,14 +213,47 @@ class ComputeStack(Stack):
             redirect_http=True,
             cluster=cluster,
             domain_zone=props.network_hosted_zone,
-            task_definition=fargate_task_definition
+            task_definition=fargate_task_definition,
+            desired_count=settings.profile.fargate_min_tasks,
         )
 
         # COMPLETED FOR YOU: Fargate service settings
-        fargate_service.target_group.configure_health_check(path="/api/v1/health")
+        fargate_service.target_group.configure_health_check(
+            path="/api/v1/health",
+            interval=Duration.seconds(settings.ALB_HEALTH_CHECK_INTERVAL_SECONDS),
+            timeout=Duration.seconds(settings.ALB_HEALTH_CHECK_INTERVAL_SECONDS // 2),
+            healthy_threshold_count=settings.ALB_HEALTHY_THRESHOLD_COUNT,
+        )
+        fargate_service.target_group.set_attribute(
+            "deregistration_delay.timeout_seconds",
+            str(settings.ALB_DEREGISTRATION_DELAY_SECONDS),
+        )
+        fargate_service.target_group.set_attribute(
+            "slow_start.duration_seconds", str(settings.ALB_SLOW_START_SECONDS)
+        )
+
+        # Scale out on whichever of request rate or CPU is hotter; scale in
+        # slowly so a short lull doesn't drain tasks a burst is about to need
+        fargate_scaling = fargate_service.service.auto_scale_task_count(
+            min_capacity=settings.profile.fargate_min_tasks,
+            max_capacity=settings.profile.fargate_max_tasks,
+        )
+        fargate_scaling.scale_on_request_count(
+            f"{settings.PROJECT_NAME}-request-scaling",
+            requests_per_target=settings.FARGATE_TARGET_REQUESTS_PER_TASK,
+            target_group=fargate_service.target_group,
+            scale_out_cooldown=Duration.seconds(settings.FARGATE_SCALE_OUT_COOLDOWN_SECONDS),
+            scale_in_cooldown=Duration.seconds(settings.FARGATE_SCALE_IN_COOLDOWN_SECONDS),
+        )
+        fargate_scaling.scale_on_cpu_utilization(
+            f"{settings.PROJECT_NAME}-cpu-scaling",
+            target_utilization_percent=settings.FARGATE_TARGET_CPU_PERCENT,
+            scale_out_cooldown=Duration.seconds(settings.FARGATE_SCALE_OUT_COOLDOWN_SECONDS),
+            scale_in_cooldown=Duration.seconds(settings.FARGATE_SCALE_IN_COOLDOWN_SECONDS),
+        )
 
         fargate_service.service.connections.allow_to(
-            props.data_aurora_db, ec2.Port.tcp(5432), "DB access"
+            props.data_db_proxy, ec2.Port.tcp(5432), "DB access"
         )
 
         # COMPLETED FOR YOU: S3 frontend deployment setup steps
@@ -180,6 +261,14 @@ class ComputeStack(Stack):
             self,
             f"{settings.PROJECT_NAME}-frontend-deployment-bucket",
         )
+        # Bundles are only tagged retired once a deploy stops referencing
+        # them, and untagged when a deploy references them again (see the
+        # retire custom resource below)
+        frontend_bucket.add_lifecycle_rule(
+            prefix=f"{settings.FRONTEND_ASSETS_PREFIX}/",
+            tag_filters={"retired": "true"},
+            expiration=Duration.days(settings.FRONTEND_ASSETS_GRACE_DAYS),
+        )
 
         access_identity = cloudfront.OriginAccessIdentity(
             self,
@@ -187,11 +276,105 @@ class ComputeStack(Stack):
         )
         frontend_bucket.grant_read(access_identity)
 
-        frontend_deployment = s3_deployment.BucketDeployment(
+        api_origin = cloudfront_origins.HttpOrigin(
+            domain_name=f"api.{settings.PROJECT_NAME}.{settings.SUNET}.{settings.COURSE_DNS_ROOT}"
+        )
+
+        # Designated public GET routes get a few seconds of edge caching ahead
+        # of the uncached /api/* catch-all (behaviors match in order). Only the
+        # listed query strings reach the cache key or the origin, and only GET
+        # and HEAD are accepted, since nothing else would be forwarded intact.
+        # An origin Cache-Control (no-store, private, stale-while-revalidate)
+        # overrides the default TTL
+        #
+        # Authorization can only reach the origin as part of the cache key. To
+        # keep authenticated requests uncached, the viewer-request function
+        # adds a query string unique to the request whenever the header is
+        # present, so those requests always miss and their responses are never
+        # served to anyone else
+        api_cache_bypass_function = cloudfront.Function(
             self,
-            f"{settings.PROJECT_NAME}-frontend-deployment",
-            sources=[s3_deployment.Source.asset(f"{settings.YOCTOGRAM_WEB_DIR}/dist")],
-            destination_bucket=frontend_bucket,
+            f"{settings.PROJECT_NAME}-api-cache-bypass-function",
+            code=cloudfront.FunctionCode.from_inline(
+                f"var BYPASS = {json.dumps(API_CACHE_BYPASS_QUERY_STRING)};"
+                """
+function handler(event) {
+    var request = event.request;
+    if (request.headers.authorization) {
+        request.querystring[BYPASS] = { value: event.context.requestId };
+    }
+    return request;
+}
+"""
+            ),
+        )
+
+        api_behaviors = {}
+        for path_pattern, query_strings in settings.API_CACHEABLE_PATHS.items():
+            api_cache_policy = cloudfront.CachePolicy(
+                self,
+                f"{settings.PROJECT_NAME}-api-cache-policy-{len(api_behaviors)}",
+                min_ttl=Duration.seconds(0),
+                default_ttl=Duration.seconds(settings.API_CACHE_DEFAULT_TTL_SECONDS),
+                max_ttl=Duration.seconds(settings.API_CACHE_MAX_TTL_SECONDS),
+                header_behavior=cloudfront.CacheHeaderBehavior.allow_list("Authorization"),
+                query_string_behavior=cloudfront.CacheQueryStringBehavior.allow_list(
+                    *query_strings, API_CACHE_BYPASS_QUERY_STRING
+                ),
+                cookie_behavior=cloudfront.CacheCookieBehavior.none(),
+                enable_accept_encoding_brotli=True,
+                enable_accept_encoding_gzip=True,
+            )
+            api_behaviors[path_pattern] = cloudfront.BehaviorOptions(
+                allowed_methods=cloudfront.AllowedMethods.ALLOW_GET_HEAD,
+                cached_methods=cloudfront.CachedMethods.CACHE_GET_HEAD,
+                origin=api_origin,
+                viewer_protocol_policy=cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
+                cache_policy=api_cache_policy,
+                function_associations=[
+                    cloudfront.FunctionAssociation(
+                        function=api_cache_bypass_function,
+                        event_type=cloudfront.FunctionEventType.VIEWER_REQUEST,
+                    )
+                ],
+            )
+
+        api_behaviors["/api/*"] = cloudfront.BehaviorOptions(
+            allowed_methods=cloudfront.AllowedMethods.ALLOW_ALL,
+            origin=api_origin,
+            viewer_protocol_policy=cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
+            origin_request_policy=cloudfront.OriginRequestPolicy.ALL_VIEWER_EXCEPT_HOST_HEADER,
+            cache_policy=cloudfront.CachePolicy.CACHING_DISABLED
+        )
+
+        # Hashed bundles are also uploaded Brotli- and gzip-compressed next to
+        # the originals (<file>.br, <file>.gz); send viewers that accept an
+        # encoding to that copy instead of compressing at the edge
+        precompressed_asset_pattern = "^/{}/.+({})$".format(
+            settings.FRONTEND_ASSETS_PREFIX,
+            "|".join(re.escape(extension) for extension in PRECOMPRESSED_CONTENT_TYPES),
+        )
+        precompressed_asset_function = cloudfront.Function(
+            self,
+            f"{settings.PROJECT_NAME}-precompressed-asset-function",
+            code=cloudfront.FunctionCode.from_inline(
+                f"var ASSETS = new RegExp({json.dumps(precompressed_asset_pattern)});"
+                """
+function handler(event) {
+    var request = event.request;
+    var header = request.headers["accept-encoding"];
+    if (!header || !ASSETS.test(request.uri)) {
+        return request;
+    }
+    if (header.value.indexOf("br") !== -1) {
+        request.uri += ".br";
+    } else if (header.value.indexOf("gzip") !== -1) {
+        request.uri += ".gz";
+    }
+    return request;
+}
+"""
+            ),
         )
 
         # FILLMEIN: Cloudfront distribution for frontend
@@ -203,20 +386,16 @@ class ComputeStack(Stack):
                     bucket=frontend_bucket,
                     origin_access_identity=access_identity,
                 ),
-                viewer_protocol_policy=cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS
+                viewer_protocol_policy=cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
+                function_associations=[
+                    cloudfront.FunctionAssociation(
+                        function=precompressed_asset_function,
+                        event_type=cloudfront.FunctionEventType.VIEWER_REQUEST,
+                    )
+                ],
             ),
             default_root_object="index.html",
-            additional_behaviors={
-                "/api/*": cloudfront.BehaviorOptions(
-                    allowed_methods=cloudfront.AllowedMethods.ALLOW_ALL,
-                    origin=cloudfront_origins.HttpOrigin(
-                        domain_name=f"api.{settings.PROJECT_NAME}.{settings.SUNET}.{settings.COURSE_DNS_ROOT}"
-                    ),
-                    viewer_protocol_policy=cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
-                    origin_request_policy=cloudfront.OriginRequestPolicy.ALL_VIEWER_EXCEPT_HOST_HEADER,
-                    cache_policy=cloudfront.CachePolicy.CACHING_DISABLED
-                )
-            },
+            additional_behaviors=api_behaviors,
             domain_names=[f"{settings.PROJECT_NAME}.{settings.SUNET}.{settings.COURSE_DNS_ROOT}"],
             certificate=props.network_frontend_certificate,
             error_responses=[
@@ -229,6 +408,91 @@ class ComputeStack(Stack):
         )
 
 
+        # Frontend deployment in two passes. Fingerprinted bundles under
+        # FRONTEND_ASSETS_PREFIX are immutable and not pruned, so clients
+        # still running an older index.html can load their bundles until the
+        # grace period runs out; the rest (index.html, favicon, ...) gets a
+        # short TTL, is pruned, and is invalidated once the new bundles are
+        # in place
+        dist_dir = f"{settings.YOCTOGRAM_WEB_DIR}/dist"
+        immutable_cache_control = [
+            s3_deployment.CacheControl.from_string("public, max-age=31536000, immutable")
+        ]
+
+        assets_deployment = s3_deployment.BucketDeployment(
+            self,
+            f"{settings.PROJECT_NAME}-frontend-assets-deployment",
+            sources=[
+                s3_deployment.Source.asset(f"{dist_dir}/{settings.FRONTEND_ASSETS_PREFIX}")
+            ],
+            destination_bucket=frontend_bucket,
+            destination_key_prefix=f"{settings.FRONTEND_ASSETS_PREFIX}/",
+            cache_control=immutable_cache_control,
+            prune=False,
+        )
+
+        for (encoding, extension), staging_dir in precompress_assets(
+            dist_dir,
+            settings.FRONTEND_ASSETS_PREFIX,
+            f"{Stage.of(self).outdir}/.frontend-precompressed",
+        ).items():
+            precompressed_deployment = s3_deployment.BucketDeployment(
+                self,
+                f"{settings.PROJECT_NAME}-frontend-assets-{encoding}-{extension.lstrip('.')}-deployment",
+                sources=[s3_deployment.Source.asset(staging_dir)],
+                destination_bucket=frontend_bucket,
+                cache_control=immutable_cache_control,
+                content_encoding=encoding,
+                content_type=PRECOMPRESSED_CONTENT_TYPES[extension],
+                prune=False,
+            )
+            assets_deployment.node.add_dependency(precompressed_deployment)
+
+        frontend_deployment = s3_deployment.BucketDeployment(
+            self,
+            f"{settings.PROJECT_NAME}-frontend-deployment",
+            sources=[s3_deployment.Source.asset(dist_dir)],
+            destination_bucket=frontend_bucket,
+            exclude=[f"{settings.FRONTEND_ASSETS_PREFIX}/*"],
+            cache_control=[
+                s3_deployment.CacheControl.from_string(
+                    f"public, max-age={settings.FRONTEND_HTML_MAX_AGE_SECONDS}, must-revalidate"
+                )
+            ],
+            distribution=frontend_distribution,
+            distribution_paths=["/", "/index.html"],
+        )
+        frontend_deployment.node.add_dependency(assets_deployment)
+
+        retire_assets_fn = lambda_.Function(
+            self,
+            f"{settings.PROJECT_NAME}-frontend-retire-assets",
+            runtime=lambda_.Runtime.PYTHON_3_11,
+            handler="retire_assets.handler",
+            code=lambda_.Code.from_asset("handlers"),
+            timeout=Duration.minutes(5),
+        )
+        frontend_bucket.grant_read(retire_assets_fn)
+        frontend_bucket.grant_put(retire_assets_fn)
+        retire_assets_provider = custom_resources.Provider(
+            self,
+            f"{settings.PROJECT_NAME}-frontend-retire-assets-provider",
+            on_event_handler=retire_assets_fn,
+        )
+        # Runs whenever the set of current bundles changes, after index.html
+        # has switched over to them
+        retire_assets = CustomResource(
+            self,
+            f"{settings.PROJECT_NAME}-frontend-retire-assets-resource",
+            service_token=retire_assets_provider.service_token,
+            properties={
+                "Bucket": frontend_bucket.bucket_name,
+                "Prefix": f"{settings.FRONTEND_ASSETS_PREFIX}/",
+                "Keys": asset_keys(dist_dir, settings.FRONTEND_ASSETS_PREFIX),
+            },
+        )
+        retire_assets.node.add_dependency(frontend_deployment)
+
         # COMPLETED FOR YOU: DNS A record for Cloudfront frontend
         frontend_domain = r53.ARecord(
             self,
@@ -1,12 +1,28 @@
+import json
+from typing import Union
+
 from aws_cdk import (
     Duration,
+    Fn,
+    Names,
+    RemovalPolicy,
     Stack,
+    aws_applicationautoscaling as appscaling,
     aws_cloudfront as cloudfront,
+    aws_cloudfront_origins as cloudfront_origins,
+    aws_cloudwatch as cloudwatch,
+    aws_dynamodb as dynamodb,
     aws_ec2 as ec2,
+    aws_ecr_assets as ecr_assets,
+    aws_ecs as ecs,
+    aws_ecs_patterns as ecs_patterns,
+    aws_iam as iam,
     aws_lambda as lambda_,
     aws_lambda_event_sources as lambda_event_sources,
     aws_rds as rds,
     aws_s3 as s3,
+    aws_s3_notifications as s3n,
+    aws_sqs as sqs,
 )
 
 from aws_solutions_constructs import aws_cloudfront_s3 as cfs3
@@ -16,30 +32,97 @@ from cdk.util import settings, Props
 
 
 class DataStack(Stack):
-    aurora_db: rds.ServerlessCluster
+    aurora_db: Union[rds.DatabaseCluster, rds.DatabaseClusterFromSnapshot]
+    db_proxy: rds.DatabaseProxy
     s3_public_images: s3.Bucket
     s3_private_images: s3.Bucket
     cloudfront_public_images: cloudfront.Distribution
     cloudfront_private_images: cloudfront.Distribution
+    manifest_queue: sqs.Queue
 
     def __init__(
         self, scope: Construct, construct_id: str, props: Props, **kwargs
     ) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
+        profile = settings.profile
+        if profile.architecture == "arm64":
+            lambda_architecture = lambda_.Architecture.ARM_64
+            cpu_architecture = ecs.CpuArchitecture.ARM64
+            image_platform = ecr_assets.Platform.LINUX_ARM64
+        else:
+            lambda_architecture = lambda_.Architecture.X86_64
+            cpu_architecture = ecs.CpuArchitecture.X86_64
+            image_platform = ecr_assets.Platform.LINUX_AMD64
+
         # FILLMEIN: Aurora Serverless Database
-        self.aurora_db = rds.ServerlessCluster(
-            self,
-            f"{settings.PROJECT_NAME}-aurora-serverless",
-            engine=rds.DatabaseClusterEngine.aurora_postgres(version=rds.AuroraPostgresEngineVersion.VER_13_10),
+        # Serverless v2 so capacity can be pinned explicitly and RDS Proxy (which
+        # does not support Serverless v1) can pool connections in front of it
+        db_subnets = ec2.SubnetSelection(subnets=props.network_vpc.select_subnets(subnet_type=ec2.SubnetType.PRIVATE_ISOLATED).subnets)
+        aurora_props = dict(
+            # 13.15 is the first 13.x release that supports auto-pause
+            engine=rds.DatabaseClusterEngine.aurora_postgres(version=rds.AuroraPostgresEngineVersion.of("13.15", "13")),
+            writer=rds.ClusterInstance.serverless_v2("writer"),
+            serverless_v2_min_capacity=max(profile.aurora_min_acu, 0.5),
+            serverless_v2_max_capacity=profile.aurora_max_acu,
             vpc=props.network_vpc,
-            vpc_subnets=ec2.SubnetSelection(subnets=props.network_vpc.select_subnets(subnet_type=ec2.SubnetType.PRIVATE_ISOLATED).subnets),
-            default_database_name=settings.PROJECT_NAME,
-            credentials=rds.Credentials.from_generated_secret(
+            vpc_subnets=db_subnets,
+            # A replaced or deleted cluster leaves a final snapshot behind
+            removal_policy=RemovalPolicy.SNAPSHOT,
+        )
+        if settings.AURORA_SNAPSHOT_IDENTIFIER:
+            # Restores the data of the Serverless v1 cluster this replaces (see
+            # "Migrating to Aurora Serverless v2" in the README). The secret is
+            # created here so it carries dbname like the generated one does
+            snapshot_secret = rds.DatabaseSecret(
+                self,
+                f"{settings.PROJECT_NAME}-aurora-snapshot-secret",
                 username=settings.PROJECT_NAME,
-                exclude_characters=settings.DB_SPECIAL_CHARS_EXCLUDE
+                dbname=settings.PROJECT_NAME,
+                exclude_characters=settings.DB_SPECIAL_CHARS_EXCLUDE,
+            )
+            self.aurora_db = rds.DatabaseClusterFromSnapshot(
+                self,
+                f"{settings.PROJECT_NAME}-aurora-serverless",
+                snapshot_identifier=settings.AURORA_SNAPSHOT_IDENTIFIER,
+                snapshot_credentials=rds.SnapshotCredentials.from_secret(snapshot_secret),
+                **aurora_props,
+            )
+        else:
+            self.aurora_db = rds.DatabaseCluster(
+                self,
+                f"{settings.PROJECT_NAME}-aurora-serverless",
+                default_database_name=settings.PROJECT_NAME,
+                credentials=rds.Credentials.from_generated_secret(
+                    username=settings.PROJECT_NAME,
+                    exclude_characters=settings.DB_SPECIAL_CHARS_EXCLUDE
+                ),
+                **aurora_props,
+            )
+
+        if profile.aurora_auto_pause_minutes:
+            # Pausing needs a 0 ACU minimum, which this CDK version rejects
+            self.aurora_db.node.default_child.add_property_override(
+                "ServerlessV2ScalingConfiguration",
+                {
+                    "MinCapacity": 0,
+                    "MaxCapacity": profile.aurora_max_acu,
+                    "SecondsUntilAutoPause": profile.aurora_auto_pause_minutes * 60,
+                },
             )
+
+        # Tasks connect through the proxy, which keeps a warm pool of server
+        # connections so task churn and bursts don't open new backends
+        self.db_proxy = self.aurora_db.add_proxy(
+            f"{settings.PROJECT_NAME}-db-proxy",
+            secrets=[self.aurora_db.secret],
+            vpc=props.network_vpc,
+            vpc_subnets=db_subnets,
+            max_connections_percent=settings.DB_PROXY_MAX_CONNECTIONS_PERCENT,
+            idle_client_timeout=Duration.minutes(settings.DB_PROXY_IDLE_CLIENT_TIMEOUT_MINUTES),
+            borrow_timeout=Duration.seconds(settings.DB_PROXY_BORROW_TIMEOUT_SECONDS),
         )
+        self.aurora_db.connections.allow_default_port_from(self.db_proxy)
 
         # COMPLETED FOR YOU: S3 Buckets and Cloudfront CDN for images
         cloudfront_response_policy = cloudfront.ResponseHeadersPolicyProps(
@@ -52,18 +135,94 @@ class DataStack(Stack):
             )
         )
 
+        # Serve the best format the viewer accepts: the viewer-request function
+        # collapses Accept to a single image type and rewrites /<key> to the
+        # matching <output prefix>/<key>.<ext> variant written by the
+        # compression Lambda, and the cache policy keys on the normalised Accept
+        # value and nothing else. Uploads themselves are never served.
+        # Outputs that do not exist (yet) fail over to the transform function
+        # below, which redirects to a variant resized from the upload.
+        # Compressed outputs carry an immutable one-year Cache-Control; anything
+        # without one only gets the short default TTL. Accept-Encoding is left
+        # out of the key since CloudFront never gzips or Brotli-compresses image
+        # types
+        image_cache_policy = cloudfront.CachePolicy(
+            self,
+            f"{settings.PROJECT_NAME}-image-cache-policy",
+            min_ttl=Duration.seconds(0),
+            default_ttl=Duration.seconds(settings.IMAGE_CDN_DEFAULT_TTL_SECONDS),
+            max_ttl=Duration.days(settings.IMAGE_CDN_MAX_TTL_DAYS),
+            header_behavior=cloudfront.CacheHeaderBehavior.allow_list("Accept"),
+            query_string_behavior=cloudfront.CacheQueryStringBehavior.none(),
+            cookie_behavior=cloudfront.CacheCookieBehavior.none(),
+        )
+
+        image_format_function = cloudfront.Function(
+            self,
+            f"{settings.PROJECT_NAME}-image-format-function",
+            code=cloudfront.FunctionCode.from_inline(
+                f"var FORMATS = {json.dumps(settings.COMPRESSION_EXTRA_FORMATS)};"
+                f"var OUTPUT_PREFIX = {json.dumps('/' + settings.COMPRESSION_OUTPUT_PREFIX)};"
+                """
+function handler(event) {
+    var request = event.request;
+    var uri = request.uri;
+    request.uri = OUTPUT_PREFIX + uri;
+    var accept = request.headers.accept ? request.headers.accept.value : "";
+    var format = "";
+    for (var i = 0; i < FORMATS.length; i++) {
+        if (uri.endsWith("." + FORMATS[i])) {
+            return request;
+        }
+        if (!format && accept.includes("image/" + FORMATS[i])) {
+            format = FORMATS[i];
+        }
+    }
+    request.headers.accept = { value: format ? "image/" + format : "image/jpeg" };
+    if (format) {
+        request.uri += "." + format;
+    }
+    return request;
+}
+"""
+            ),
+        )
+
+        cloudfront_distribution_props = {
+            "defaultBehavior": {
+                "cachePolicy": image_cache_policy,
+                "functionAssociations": [
+                    {
+                        "function": image_format_function,
+                        "eventType": cloudfront.FunctionEventType.VIEWER_REQUEST,
+                    }
+                ],
+            }
+        }
+
         cloudfront_s3_public = cfs3.CloudFrontToS3(
             self,
             f"{settings.PROJECT_NAME}-public-images-s3-cloudfront",
+            cloud_front_distribution_props=cloudfront_distribution_props,
             response_headers_policy_props=cloudfront_response_policy,
         )
 
         cloudfront_s3_private = cfs3.CloudFrontToS3(
             self,
             f"{settings.PROJECT_NAME}-private-images-s3-cloudfront",
+            cloud_front_distribution_props=cloudfront_distribution_props,
             response_headers_policy_props=cloudfront_response_policy,
         )
 
+        # Collapse edge misses from every region into one regional cache in
+        # front of each bucket; CloudFrontToS3 has no prop for this
+        for cloudfront_s3 in [cloudfront_s3_public, cloudfront_s3_private]:
+            distribution = cloudfront_s3.cloud_front_web_distribution
+            distribution.node.default_child.add_property_override(
+                "DistributionConfig.Origins.0.OriginShield",
+                {"Enabled": True, "OriginShieldRegion": settings.REGION},
+            )
+
         self.s3_public_images = cloudfront_s3_public.s3_bucket
         self.s3_private_images = cloudfront_s3_private.s3_bucket
 
@@ -89,6 +248,151 @@ class DataStack(Stack):
             ],
         )
 
+        # On-demand resizing: /t/<width>/<format>/<quality>/<key> goes to a
+        # function URL running the compression image's transform handler.
+        # Origin Shield funnels every edge's misses into one regional cache, and
+        # the function keeps each variant in the bucket, so only the first
+        # request for a variant decodes its source. The URL takes IAM auth and
+        # only the two distributions may invoke it, signing through an origin
+        # access control, so the bucket header cannot be set by anyone else
+        transform_fn = lambda_.DockerImageFunction(
+            self,
+            f"{settings.PROJECT_NAME}-image-transform-function",
+            code=lambda_.DockerImageCode.from_image_asset(
+                "../compression",
+                target="lambda",
+                cmd=["transform.handler"],
+                platform=image_platform,
+            ),
+            architecture=lambda_architecture,
+            timeout=Duration.seconds(30),
+            memory_size=profile.transform_memory_mb,
+            environment={
+                "TRANSFORM_PATH_PREFIX": settings.IMAGE_TRANSFORM_PATH_PREFIX,
+                "TRANSFORM_WIDTHS": ",".join(
+                    str(width) for width in settings.IMAGE_TRANSFORM_WIDTHS
+                ),
+                "TRANSFORM_QUALITIES": ",".join(
+                    str(format_quality)
+                    for format_quality in settings.IMAGE_TRANSFORM_QUALITIES
+                ),
+                "IMAGE_BUCKETS": ",".join(
+                    cloudfront_s3.s3_bucket.bucket_name
+                    for cloudfront_s3 in [cloudfront_s3_public, cloudfront_s3_private]
+                ),
+                "VARIANT_PREFIX": settings.IMAGE_TRANSFORM_VARIANT_PREFIX,
+                "OUTPUT_PREFIX": settings.COMPRESSION_OUTPUT_PREFIX,
+                "EXTRA_FORMATS": ",".join(settings.COMPRESSION_EXTRA_FORMATS),
+                "PROGRESSIVE_JPEG": str(settings.COMPRESSION_PROGRESSIVE_JPEG).lower(),
+                "TRANSFORM_MAX_BYTES": str(settings.IMAGE_TRANSFORM_MAX_BYTES),
+                "MAX_PIXELS": str(int(profile.transform_max_megapixels * 1_000_000)),
+                "CACHE_CONTROL": "public, max-age={}, immutable".format(
+                    Duration.days(settings.IMAGE_CDN_MAX_TTL_DAYS).to_seconds()
+                ),
+                "POWERTOOLS_METRICS_NAMESPACE": settings.PROJECT_NAME,
+                "POWERTOOLS_SERVICE_NAME": "image-transform",
+            },
+        )
+        # With provisioned concurrency the URL points at an alias of the
+        # current version, since only versions can keep instances initialised
+        transform_target: lambda_.FunctionBase = transform_fn
+        if profile.transform_provisioned_concurrency:
+            transform_target = lambda_.Alias(
+                self,
+                f"{settings.PROJECT_NAME}-image-transform-alias",
+                alias_name="live",
+                version=transform_fn.current_version,
+                provisioned_concurrent_executions=profile.transform_provisioned_concurrency,
+            )
+        transform_url = transform_target.add_function_url(
+            auth_type=lambda_.FunctionUrlAuthType.AWS_IAM
+        )
+        transform_access_control = cloudfront.CfnOriginAccessControl(
+            self,
+            f"{settings.PROJECT_NAME}-image-transform-access-control",
+            origin_access_control_config=cloudfront.CfnOriginAccessControl.OriginAccessControlConfigProperty(
+                name=f"{settings.PROJECT_NAME}-image-transform",
+                origin_access_control_origin_type="lambda",
+                signing_behavior="always",
+                signing_protocol="sigv4",
+            ),
+        )
+
+        # Variants are addressed entirely by path, and never change
+        transform_cache_policy = cloudfront.CachePolicy(
+            self,
+            f"{settings.PROJECT_NAME}-image-transform-cache-policy",
+            min_ttl=Duration.seconds(0),
+            default_ttl=Duration.days(settings.IMAGE_CDN_MAX_TTL_DAYS),
+            max_ttl=Duration.days(settings.IMAGE_CDN_MAX_TTL_DAYS),
+            header_behavior=cloudfront.CacheHeaderBehavior.none(),
+            query_string_behavior=cloudfront.CacheQueryStringBehavior.none(),
+            cookie_behavior=cloudfront.CacheCookieBehavior.none(),
+        )
+
+        for cloudfront_s3 in [cloudfront_s3_public, cloudfront_s3_private]:
+            cloudfront_s3.cloud_front_web_distribution.add_behavior(
+                f"/{settings.IMAGE_TRANSFORM_PATH_PREFIX}/*",
+                cloudfront_origins.HttpOrigin(
+                    Fn.select(2, Fn.split("/", transform_url.url)),
+                    protocol_policy=cloudfront.OriginProtocolPolicy.HTTPS_ONLY,
+                    origin_shield_region=settings.REGION,
+                    custom_headers={"x-image-bucket": cloudfront_s3.s3_bucket.bucket_name},
+                ),
+                cache_policy=transform_cache_policy,
+                viewer_protocol_policy=cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
+            )
+            cloudfront_s3.s3_bucket.grant_read_write(transform_fn)
+
+            # The transform origin is the second one, after the bucket
+            distribution = cloudfront_s3.cloud_front_web_distribution
+            distribution.node.default_child.add_property_override(
+                "DistributionConfig.Origins.1.OriginAccessControlId",
+                transform_access_control.attr_id,
+            )
+
+            # An output the compression Lambda has not written, for an upload
+            # still queued, routed to the worker or quarantined, fails over from
+            # the bucket to the transform origin, which redirects to a variant
+            # resized from the upload. CloudFrontToS3 has no prop for an origin
+            # group
+            bucket_origin_id, transform_origin_id = (
+                Names.unique_id(distribution.node.find_child(origin))
+                for origin in ["Origin1", "Origin2"]
+            )
+            origin_group_id = f"{bucket_origin_id}-failover"
+            distribution.node.default_child.add_property_override(
+                "DistributionConfig.OriginGroups",
+                {
+                    "Quantity": 1,
+                    "Items": [
+                        {
+                            "Id": origin_group_id,
+                            "FailoverCriteria": {
+                                "StatusCodes": {"Quantity": 2, "Items": [403, 404]}
+                            },
+                            "Members": {
+                                "Quantity": 2,
+                                "Items": [
+                                    {"OriginId": bucket_origin_id},
+                                    {"OriginId": transform_origin_id},
+                                ],
+                            },
+                        }
+                    ],
+                },
+            )
+            distribution.node.default_child.add_property_override(
+                "DistributionConfig.DefaultCacheBehavior.TargetOriginId", origin_group_id
+            )
+            transform_target.add_permission(
+                f"{cloudfront_s3.node.id}-invoke-url",
+                principal=iam.ServicePrincipal("cloudfront.amazonaws.com"),
+                action="lambda:InvokeFunctionUrl",
+                function_url_auth_type=lambda_.FunctionUrlAuthType.AWS_IAM,
+                source_arn=f"arn:{self.partition}:cloudfront::{self.account}:distribution/{distribution.distribution_id}",
+            )
+
         self.cloudfront_public_images = (
             cloudfront_s3_public.cloud_front_web_distribution
         )
@@ -96,21 +400,188 @@ class DataStack(Stack):
             cloudfront_s3_private.cloud_front_web_distribution
         )
 
+        # Content hash -> already produced outputs, expired through TTL
+        dedup_table = dynamodb.Table(
+            self,
+            f"{settings.PROJECT_NAME}-compression-dedup-table",
+            partition_key=dynamodb.Attribute(
+                name="hash", type=dynamodb.AttributeType.STRING
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="expires_at",
+            removal_policy=RemovalPolicy.DESTROY,
+        )
+
+        # One message per processed image, carrying its manifest, for the
+        # backend to drain in batches into the database. The backend task gets
+        # the queue URL and consume rights, but the consumer belongs to the
+        # backend app (see the README). Messages it fails to handle
+        # COMPRESSION_MANIFEST_MAX_RECEIVE_COUNT times go to a dead-letter queue
+        self.manifest_queue = sqs.Queue(
+            self,
+            f"{settings.PROJECT_NAME}-image-manifest-queue",
+            retention_period=Duration.days(14),
+            dead_letter_queue=sqs.DeadLetterQueue(
+                max_receive_count=settings.COMPRESSION_MANIFEST_MAX_RECEIVE_COUNT,
+                queue=sqs.Queue(
+                    self,
+                    f"{settings.PROJECT_NAME}-image-manifest-dlq",
+                    retention_period=Duration.days(14),
+                ),
+            ),
+        )
+
+        compression_environment = {
+            "RENDITION_SIZES": ",".join(
+                str(size) for size in settings.COMPRESSION_RENDITION_SIZES
+            ),
+            "OUTPUT_PREFIX": settings.COMPRESSION_OUTPUT_PREFIX,
+            "MAX_LONG_EDGE": str(settings.COMPRESSION_MAX_LONG_EDGE),
+            "STREAMING": str(settings.COMPRESSION_STREAMING).lower(),
+            "EXTRA_FORMATS": ",".join(settings.COMPRESSION_EXTRA_FORMATS),
+            "QUALITY_MODE": settings.COMPRESSION_QUALITY_MODE,
+            "TARGET_SSIM": str(settings.COMPRESSION_TARGET_SSIM),
+            "MAX_BYTES": str(settings.COMPRESSION_MAX_BYTES),
+            "PROGRESSIVE_JPEG": str(settings.COMPRESSION_PROGRESSIVE_JPEG).lower(),
+            "PLACEHOLDER": settings.COMPRESSION_PLACEHOLDER,
+            "CACHE_CONTROL": "public, max-age={}, immutable".format(
+                Duration.days(settings.IMAGE_CDN_MAX_TTL_DAYS).to_seconds()
+            ),
+            "DEDUP_TABLE": dedup_table.table_name,
+            "DEDUP_TTL_DAYS": str(settings.COMPRESSION_DEDUP_TTL_DAYS),
+            "MANIFEST": str(settings.COMPRESSION_MANIFEST).lower(),
+            "MANIFEST_QUEUE_URL": self.manifest_queue.queue_url,
+            "POWERTOOLS_METRICS_NAMESPACE": settings.PROJECT_NAME,
+        }
+
+        # Messages that keep failing for reasons other than the image itself
+        # (those are tagged quarantine=<error> and dropped) end up here rather
+        # than being retried indefinitely
+        compression_dead_letter_queue = sqs.DeadLetterQueue(
+            max_receive_count=settings.COMPRESSION_MAX_RECEIVE_COUNT,
+            queue=sqs.Queue(
+                self,
+                f"{settings.PROJECT_NAME}-compression-dlq",
+                retention_period=Duration.days(14),
+            ),
+        )
+
+        # Uploads too large for the Lambda are forwarded here by the Lambda
+        # itself, which sees the size on GetObject and the pixel count in the
+        # header, before anything is decoded
+        # The worker keeps extending this while a message is being processed
+        large_image_visibility_timeout = Duration.minutes(15)
+        large_image_queue = sqs.Queue(
+            self,
+            f"{settings.PROJECT_NAME}-compression-large-queue",
+            visibility_timeout=large_image_visibility_timeout,
+            dead_letter_queue=compression_dead_letter_queue,
+        )
+
+        # Sized to the worker's memory rather than the Lambda's, since every
+        # source over the Lambda's own limit is routed to the worker
+        worker_max_pixels = str(int(profile.worker_max_megapixels * 1_000_000))
+
         lambda_fn = lambda_.DockerImageFunction(self, "Function",
-            code=lambda_.DockerImageCode.from_image_asset("../compression"),
-            architecture=lambda_.Architecture.ARM_64,
-            timeout=Duration.seconds(30),
-            memory_size=1536
+            code=lambda_.DockerImageCode.from_image_asset(
+                "../compression", target="lambda", platform=image_platform
+            ),
+            architecture=lambda_architecture,
+            timeout=Duration.seconds(profile.compression_timeout_seconds),
+            memory_size=profile.compression_memory_mb,
+            reserved_concurrent_executions=profile.compression_reserved_concurrency,
+            environment={
+                **compression_environment,
+                "POWERTOOLS_SERVICE_NAME": "compression",
+                "BATCH_WORKERS": str(settings.COMPRESSION_BATCH_WORKERS),
+                "LARGE_QUEUE_URL": large_image_queue.queue_url,
+                "ROUTE_MAX_BYTES": str(settings.COMPRESSION_LAMBDA_MAX_BYTES),
+                "ROUTE_MAX_PIXELS": str(int(profile.compression_max_megapixels * 1_000_000)),
+                # Only headers are parsed above ROUTE_MAX_PIXELS, so the Lambda
+                # takes the worker's limit and quarantines only what the worker
+                # would refuse as well
+                "MAX_PIXELS": worker_max_pixels,
+            },
+        )
+
+        # Same image built to its worker stage; scales from zero on queue depth.
+        # Metrics carry service=compression-worker so each path's throughput
+        # (Processed, Pixels, InputBytes over BatchDuration) is reported apart
+        compression_worker = ecs_patterns.QueueProcessingFargateService(
+            self,
+            f"{settings.PROJECT_NAME}-compression-worker",
+            vpc=props.network_vpc,
+            queue=large_image_queue,
+            image=ecs.ContainerImage.from_asset(
+                "../compression",
+                target="worker",
+                platform=image_platform,
+            ),
+            runtime_platform=ecs.RuntimePlatform(
+                operating_system_family=ecs.OperatingSystemFamily.LINUX,
+                cpu_architecture=cpu_architecture,
+            ),
+            cpu=profile.worker_cpu,
+            memory_limit_mib=profile.worker_memory_mib,
+            environment={
+                **compression_environment,
+                "POWERTOOLS_SERVICE_NAME": "compression-worker",
+                "BATCH_WORKERS": str(settings.COMPRESSION_WORKER_BATCH_WORKERS),
+                "WORKER_QUEUE_URL": large_image_queue.queue_url,
+                "WORKER_BATCH_SIZE": str(settings.COMPRESSION_WORKER_BATCH_SIZE),
+                "MAX_PIXELS": worker_max_pixels,
+                "WORKER_VISIBILITY_TIMEOUT_SECONDS": str(
+                    large_image_visibility_timeout.to_seconds()
+                ),
+            },
+            min_scaling_capacity=0,
+            max_scaling_capacity=profile.worker_max_tasks,
+            scaling_steps=[
+                appscaling.ScalingInterval(upper=0, change=-1),
+                appscaling.ScalingInterval(lower=1, change=+1),
+            ],
         )
     
-        lambda_fn.add_event_source(lambda_event_sources.S3EventSource(self.s3_public_images,
-            events=[s3.EventType.OBJECT_CREATED_POST]
-            )
+        # S3 notifications are buffered in a queue so uploads are compressed in
+        # batches rather than one invocation per object. Every object-created
+        # type is subscribed, since large files arrive through PUT and multipart,
+        # but only for keys starting with one of the upload initials, so the
+        # outputs and variants under their "_" prefixes never reach the queue
+        compression_queue = sqs.Queue(
+            self,
+            f"{settings.PROJECT_NAME}-compression-queue",
+            # AWS recommends at least 6x the function timeout for SQS sources
+            visibility_timeout=Duration.seconds(6 * profile.compression_timeout_seconds),
+            dead_letter_queue=compression_dead_letter_queue,
         )
-        lambda_fn.add_event_source(lambda_event_sources.S3EventSource(self.s3_private_images,
-            events=[s3.EventType.OBJECT_CREATED_POST]
+
+        for bucket in [self.s3_public_images, self.s3_private_images]:
+            for initial in settings.COMPRESSION_UPLOAD_KEY_INITIALS:
+                bucket.add_event_notification(
+                    s3.EventType.OBJECT_CREATED,
+                    s3n.SqsDestination(compression_queue),
+                    s3.NotificationKeyFilter(prefix=initial),
+                )
+
+        lambda_fn.add_event_source(lambda_event_sources.SqsEventSource(compression_queue,
+            batch_size=settings.COMPRESSION_BATCH_SIZE,
+            max_batching_window=Duration.seconds(settings.COMPRESSION_BATCH_WINDOW_SECONDS),
+            report_batch_item_failures=True,
+            # Keep the poller within the reserved concurrency so messages are
+            # not throttled into the dead-letter queue
+            max_concurrency=profile.compression_reserved_concurrency,
             )
         )
 
         self.s3_public_images.grant_read_write(lambda_fn)
         self.s3_private_images.grant_read_write(lambda_fn)
+        dedup_table.grant_read_write_data(lambda_fn)
+        large_image_queue.grant_send_messages(lambda_fn)
+        self.manifest_queue.grant_send_messages(lambda_fn)
+
+        worker_role = compression_worker.task_definition.task_role
+        self.s3_public_images.grant_read_write(worker_role)
+        self.s3_private_images.grant_read_write(worker_role)
+        dedup_table.grant_read_write_data(worker_role)
+        self.manifest_queue.grant_send_messages(worker_role)
+        cloudwatch.Metric.grant_put_metric_data(worker_role)
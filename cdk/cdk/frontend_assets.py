@@ -0,0 +1,79 @@
+import gzip
+import os
+import shutil
+from typing import Dict, List, Tuple
+
+import brotli
+
+# Hashed bundle files worth serving pre-compressed, with their content types
+PRECOMPRESSED_CONTENT_TYPES: Dict[str, str] = {
+    ".js": "application/javascript",
+    ".css": "text/css",
+    ".svg": "image/svg+xml",
+}
+
+# Content-Encoding -> key suffix of the pre-compressed copy
+ENCODINGS: Dict[str, str] = {"br": ".br", "gzip": ".gz"}
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=11)
+    # mtime=0 keeps the output, and so the CDK asset hash, stable across synths
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def _asset_paths(dist_dir: str, assets_prefix: str) -> List[str]:
+    return [
+        os.path.join(root, name)
+        for root, _, files in sorted(os.walk(os.path.join(dist_dir, assets_prefix)))
+        for name in sorted(files)
+    ]
+
+
+def asset_keys(dist_dir: str, assets_prefix: str) -> List[str]:
+    """Return the bucket keys a deployment of dist_dir/assets_prefix writes,
+    pre-compressed copies included.
+    """
+    keys = []
+    for path in _asset_paths(dist_dir, assets_prefix):
+        key = os.path.relpath(path, dist_dir).replace(os.sep, "/")
+        keys.append(key)
+        if os.path.splitext(path)[1] in PRECOMPRESSED_CONTENT_TYPES:
+            keys.extend(key + suffix for suffix in ENCODINGS.values())
+    return keys
+
+
+def precompress_assets(
+    dist_dir: str, assets_prefix: str, staging_root: str
+) -> Dict[Tuple[str, str], str]:
+    """Write Brotli and gzip copies of the compressible files under
+    dist_dir/assets_prefix, keeping their paths relative to dist_dir, into one
+    directory per (encoding, extension) under staging_root and return those
+    directories. staging_root is emptied first, so each synth replaces the
+    previous one's output.
+    """
+    shutil.rmtree(staging_root, ignore_errors=True)
+    staging_dirs: Dict[Tuple[str, str], str] = {}
+
+    for path in _asset_paths(dist_dir, assets_prefix):
+        extension = os.path.splitext(path)[1]
+        if extension not in PRECOMPRESSED_CONTENT_TYPES:
+            continue
+
+        with open(path, "rb") as source:
+            data = source.read()
+
+        for encoding, suffix in ENCODINGS.items():
+            staging_dir = staging_dirs.setdefault(
+                (encoding, extension),
+                os.path.join(staging_root, encoding, extension.lstrip(".")),
+            )
+            target = os.path.join(
+                staging_dir, os.path.relpath(path, dist_dir) + suffix
+            )
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, "wb") as output:
+                output.write(compress(data, encoding))
+
+    return staging_dirs
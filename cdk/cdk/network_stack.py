@@ -2,6 +2,7 @@ from aws_cdk import (
     Stack,
     aws_certificatemanager as acm,
     aws_ec2 as ec2,
+    aws_iam as iam,
     aws_route53 as r53,
 )
 from constructs import Construct
@@ -23,7 +24,10 @@ class NetworkStack(Stack):
         self.vpc = ec2.Vpc(
             self,
             f"{settings.PROJECT_NAME}-vpc",
-            availability_zones=["us-west-2a", "us-west-2b"],
+            availability_zones=[
+                f"{settings.REGION}{zone}"
+                for zone in "abcd"[: settings.profile.availability_zones]
+            ],
             ip_addresses=ec2.IpAddresses.cidr("10.0.0.0/16"),
             subnet_configuration=[
                 { 
@@ -44,6 +48,98 @@ class NetworkStack(Stack):
             ]
         )
 
+        # Keep image pulls, image bucket traffic, secret fetches and log shipping
+        # off the NAT gateways. Each endpoint only admits the project's own
+        # resources; generated bucket and log group names start with the stack
+        # name, generated secret names with the construct ID
+        s3_endpoint = self.vpc.add_gateway_endpoint(
+            f"{settings.PROJECT_NAME}-s3-endpoint",
+            service=ec2.GatewayVpcEndpointAwsService.S3,
+            subnets=[ec2.SubnetSelection(subnet_type=ec2.SubnetType.PRIVATE_WITH_EGRESS)],
+        )
+        s3_endpoint.add_to_policy(
+            iam.PolicyStatement(
+                principals=[iam.AnyPrincipal()],
+                actions=["s3:*"],
+                resources=[
+                    f"arn:aws:s3:::{settings.PROJECT_NAME}-*",
+                    f"arn:aws:s3:::{settings.PROJECT_NAME}-*/*",
+                ],
+            )
+        )
+        # ECR serves image layers from its own bucket
+        s3_endpoint.add_to_policy(
+            iam.PolicyStatement(
+                principals=[iam.AnyPrincipal()],
+                actions=["s3:GetObject"],
+                resources=[f"arn:aws:s3:::prod-{self.region}-starport-layer-bucket/*"],
+            )
+        )
+
+        # Pulls from the app repository and from the CDK container asset
+        # repository (the compression worker image)
+        ecr_pull = iam.PolicyStatement(
+            principals=[iam.AnyPrincipal()],
+            actions=[
+                "ecr:BatchCheckLayerAvailability",
+                "ecr:BatchGetImage",
+                "ecr:GetDownloadUrlForLayer",
+            ],
+            resources=[
+                f"arn:aws:ecr:{self.region}:{self.account}:repository/cs40*",
+                f"arn:aws:ecr:{self.region}:{self.account}:repository/cdk-*-container-assets-*",
+            ],
+        )
+
+        interface_endpoints = {
+            "ecr-api": (
+                ec2.InterfaceVpcEndpointAwsService.ECR,
+                [
+                    iam.PolicyStatement(
+                        principals=[iam.AnyPrincipal()],
+                        actions=["ecr:GetAuthorizationToken"],
+                        resources=["*"],
+                    ),
+                    ecr_pull,
+                ],
+            ),
+            "ecr-dkr": (ec2.InterfaceVpcEndpointAwsService.ECR_DOCKER, [ecr_pull]),
+            "secrets-manager": (
+                ec2.InterfaceVpcEndpointAwsService.SECRETS_MANAGER,
+                [
+                    iam.PolicyStatement(
+                        principals=[iam.AnyPrincipal()],
+                        actions=["secretsmanager:GetSecretValue", "secretsmanager:DescribeSecret"],
+                        resources=[
+                            f"arn:aws:secretsmanager:{self.region}:{self.account}:secret:{settings.PROJECT_NAME}*"
+                        ],
+                    ),
+                ],
+            ),
+            "logs": (
+                ec2.InterfaceVpcEndpointAwsService.CLOUDWATCH_LOGS,
+                [
+                    iam.PolicyStatement(
+                        principals=[iam.AnyPrincipal()],
+                        actions=["logs:CreateLogStream", "logs:PutLogEvents"],
+                        resources=[
+                            f"arn:aws:logs:{self.region}:{self.account}:log-group:{settings.PROJECT_NAME}-*"
+                        ],
+                    ),
+                ],
+            ),
+        }
+
+        for name, (service, statements) in interface_endpoints.items():
+            endpoint = self.vpc.add_interface_endpoint(
+                f"{settings.PROJECT_NAME}-{name}-endpoint",
+                service=service,
+                subnets=ec2.SubnetSelection(subnet_type=ec2.SubnetType.PRIVATE_WITH_EGRESS),
+                private_dns_enabled=True,
+            )
+            for statement in statements:
+                endpoint.add_to_policy(statement)
+
         # FILLMEIN: TLS certificate for backend
         self.backend_certificate = acm.Certificate(
             self,
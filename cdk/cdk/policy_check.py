@@ -0,0 +1,147 @@
+"""Merge the synthesized templates and evaluate the policy rules against them.
+
+    python -m cdk.policy_check --rules ../autograder/rules
+
+Replaces the `jq -s reduce` pipe of grade*.sh: the network, data and compute
+templates in cdk.out are merged into a single Resources map (without
+CDKMetadata) in Python. The rules themselves are still evaluated by
+`opa eval`, over the whole merged input, since they may relate resources to
+each other; data.rules.main violations are printed.
+
+Merged inputs and rule results are cached under cdk.out/.policy-cache, keyed
+by the template and rule file hashes, so re-checking an unchanged tree does
+not run opa. Only the CACHE_ENTRIES most recently used inputs and results are
+kept.
+"""
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+from typing import Any, Dict, List
+
+DEFAULT_STACKS = ["network", "data", "compute"]
+CACHE_DIR_NAME = ".policy-cache"
+CACHE_ENTRIES = 8
+
+
+def file_digest(path: str) -> str:
+    with open(path, "rb") as source:
+        return hashlib.sha256(source.read()).hexdigest()
+
+
+def rules_digest(rules_dir: str) -> str:
+    digest = hashlib.sha256()
+    for root, _, files in sorted(os.walk(rules_dir)):
+        for name in sorted(files):
+            if name.endswith((".rego", ".json")):
+                path = os.path.join(root, name)
+                digest.update(os.path.relpath(path, rules_dir).encode())
+                digest.update(file_digest(path).encode())
+    return digest.hexdigest()
+
+
+def merge_templates(template_paths: List[str]) -> Dict[str, Any]:
+    resources: Dict[str, Any] = {}
+    for path in template_paths:
+        with open(path) as template:
+            resources.update(json.load(template).get("Resources", {}))
+    resources.pop("CDKMetadata", None)
+    return {"Resources": resources}
+
+
+def load_merged(cache_dir: str, template_paths: List[str]) -> str:
+    """Return the path of the merged input for these templates, merging only
+    when no cached copy exists for their current contents."""
+    key = hashlib.sha256(
+        "".join(file_digest(path) for path in template_paths).encode()
+    ).hexdigest()
+    merged_path = os.path.join(cache_dir, f"input-{key}.json")
+
+    if not os.path.exists(merged_path):
+        with open(merged_path, "w") as merged:
+            json.dump(merge_templates(template_paths), merged)
+
+    return merged_path
+
+
+def evaluate(merged_path: str, rules_dir: str) -> List[str]:
+    result = subprocess.run(
+        ["opa", "eval", "-b", rules_dir, "-i", merged_path, "-f", "json", "data.rules.main"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return [
+        violation
+        for query_result in json.loads(result.stdout).get("result", [])
+        for expression in query_result["expressions"]
+        for violation in expression["value"].get("violations", [])
+    ]
+
+
+def evict(cache_dir: str, keep: List[str]) -> None:
+    """Delete all but the CACHE_ENTRIES most recently used inputs and results,
+    never the ones in keep."""
+    for prefix in ["input-", "result-"]:
+        paths = sorted(
+            (
+                os.path.join(cache_dir, name)
+                for name in os.listdir(cache_dir)
+                if name.startswith(prefix)
+            ),
+            key=os.path.getmtime,
+            reverse=True,
+        )
+        for path in paths[CACHE_ENTRIES:]:
+            if path not in keep:
+                os.remove(path)
+
+
+def check(cdk_out: str, rules_dir: str, project: str, stacks: List[str]) -> List[str]:
+    cache_dir = os.path.join(cdk_out, CACHE_DIR_NAME)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    template_paths = [
+        os.path.join(cdk_out, f"{project}-{stack}-stack.template.json")
+        for stack in stacks
+    ]
+    merged_path = load_merged(cache_dir, template_paths)
+
+    result_path = os.path.join(
+        cache_dir,
+        f"result-{os.path.basename(merged_path)[len('input-'):-len('.json')]}"
+        f"-{rules_digest(rules_dir)}.json",
+    )
+    if os.path.exists(result_path):
+        with open(result_path) as cached:
+            violations = json.load(cached)
+    else:
+        violations = evaluate(merged_path, rules_dir)
+        with open(result_path, "w") as result:
+            json.dump(violations, result)
+
+    # Mark both as used so eviction keeps the latest entries
+    for path in [merged_path, result_path]:
+        os.utime(path)
+    evict(cache_dir, [merged_path, result_path])
+
+    return violations
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rules", required=True, help="directory of .rego rules")
+    parser.add_argument("--cdk-out", default="cdk.out")
+    parser.add_argument("--project", default="yoctogram")
+    parser.add_argument("--stacks", default=",".join(DEFAULT_STACKS))
+    args = parser.parse_args()
+
+    for violation in check(
+        args.cdk_out, args.rules, args.project, args.stacks.split(",")
+    ):
+        print(violation)
+
+
+if __name__ == "__main__":
+    main()
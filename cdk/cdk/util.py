@@ -1,5 +1,5 @@
 import string
-from typing import Dict, Optional
+from typing import Dict, List, Literal, Optional, Union
 
 from aws_cdk import (
     aws_certificatemanager as acm,
@@ -8,12 +8,175 @@ from aws_cdk import (
     aws_rds as rds,
     aws_route53 as r53,
     aws_s3 as s3,
+    aws_sqs as sqs,
 )
-from pydantic import field_validator
+from pydantic import BaseModel, ConfigDict, field_validator
 from pydantic_core.core_schema import ValidationInfo
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
+# Task memory sizes (MiB) Fargate accepts for each task CPU size
+FARGATE_MEMORY_BY_CPU: Dict[int, List[int]] = {
+    256: [512, 1024, 2048],
+    512: list(range(1024, 4096 + 1, 1024)),
+    1024: list(range(2048, 8192 + 1, 1024)),
+    2048: list(range(4096, 16384 + 1, 1024)),
+    4096: list(range(8192, 30720 + 1, 1024)),
+    8192: list(range(16384, 61440 + 1, 4096)),
+    16384: list(range(32768, 122880 + 1, 8192)),
+}
+
+# Peak RSS of the compression code with no long-edge cap: ~70 MiB after
+# imports plus ~9.5 MiB per source megapixel for JPEG and PNG alike (259 MiB
+# for 20 MP, 297 MiB for 24 MP), rounded up for the allocator's slack
+IMAGE_BASE_MEMORY_MB = 128
+IMAGE_MEMORY_MB_PER_MEGAPIXEL = 11
+
+
+def image_memory_mb(megapixels: float, concurrent_images: int) -> int:
+    return IMAGE_BASE_MEMORY_MB + int(
+        IMAGE_MEMORY_MB_PER_MEGAPIXEL * megapixels * concurrent_images
+    )
+
+
+class PerformanceProfile(BaseModel):
+    # Validate defaults too, as BaseSettings does, so every profile is checked
+    model_config = ConfigDict(validate_default=True)
+
+    architecture: Literal["arm64", "x86_64"] = "arm64"
+    availability_zones: int = 2
+
+    # Backend service: size of each task (app container plus Datadog sidecar)
+    # and the autoscaling range
+    fargate_cpu: int = 512
+    fargate_memory_mib: int = 2048
+    fargate_min_tasks: int = 1
+    fargate_max_tasks: int = 4
+
+    # Aurora Serverless v2 capacity in ACUs (0.5 steps). A non-zero auto-pause
+    # lets the cluster scale to 0 ACUs when idle, at the cost of a resume delay
+    # on the next connection
+    aurora_min_acu: float = 0.5
+    aurora_max_acu: float = 4
+    aurora_auto_pause_minutes: int = 0
+
+    # Compression Lambda; sources over compression_max_megapixels are routed to
+    # the worker. None leaves concurrency unreserved
+    compression_memory_mb: int = 1024
+    compression_timeout_seconds: int = 30
+    compression_reserved_concurrency: Optional[int] = None
+    compression_max_megapixels: float = 20
+
+    # On-demand transform Lambda; provisioned instances stay initialised so a
+    # CDN miss does not pay for a cold start. Sources over
+    # transform_max_megapixels are refused rather than decoded
+    transform_memory_mb: int = 1024
+    transform_max_megapixels: float = 60
+    transform_provisioned_concurrency: int = 0
+
+    # Fargate worker for images too large for the Lambda. Sources over
+    # worker_max_megapixels are the one limit left: they are quarantined from
+    # the header alone, by the Lambda or the worker, and never decoded
+    worker_cpu: int = 2048
+    worker_memory_mib: int = 8192
+    worker_max_tasks: int = 2
+    worker_max_megapixels: float = 300
+
+    @field_validator("availability_zones")
+    @classmethod
+    def validate_availability_zones(cls, v: int) -> int:
+        # The ALB, Aurora and the RDS Proxy all need subnets in two AZs
+        if not 2 <= v <= 4:
+            raise ValueError("availability_zones must be 2-4")
+        return v
+
+    @field_validator("fargate_memory_mib", "worker_memory_mib")
+    @classmethod
+    def validate_fargate_size(cls, v: int, info: ValidationInfo) -> int:
+        cpu = info.data.get(info.field_name.replace("memory_mib", "cpu"))
+        if v not in FARGATE_MEMORY_BY_CPU.get(cpu, []):
+            raise ValueError(f"Fargate does not support {cpu} CPU units with {v} MiB")
+        return v
+
+    @field_validator("fargate_max_tasks")
+    @classmethod
+    def validate_fargate_task_range(cls, v: int, info: ValidationInfo) -> int:
+        if v < info.data.get("fargate_min_tasks", 1):
+            raise ValueError("fargate_max_tasks must be at least fargate_min_tasks")
+        return v
+
+    @field_validator("aurora_min_acu", "aurora_max_acu")
+    @classmethod
+    def validate_aurora_acu(cls, v: float) -> float:
+        if v < 0 or v > 128 or (v * 2) % 1:
+            raise ValueError("Aurora capacity must be 0-128 ACUs in steps of 0.5")
+        return v
+
+    @field_validator("aurora_max_acu")
+    @classmethod
+    def validate_aurora_acu_range(cls, v: float, info: ValidationInfo) -> float:
+        if v < max(info.data.get("aurora_min_acu", 0.5), 1):
+            raise ValueError("aurora_max_acu must be at least aurora_min_acu and 1")
+        return v
+
+    @field_validator("compression_memory_mb", "transform_memory_mb")
+    @classmethod
+    def validate_lambda_memory(cls, v: int) -> int:
+        if not 128 <= v <= 10240:
+            raise ValueError("Lambda memory must be 128-10240 MB")
+        return v
+
+    @field_validator("compression_reserved_concurrency")
+    @classmethod
+    def validate_reserved_concurrency(cls, v: Optional[int]) -> Optional[int]:
+        # Also the SQS poller's maximum concurrency, which cannot be below 2
+        if v is not None and v < 2:
+            raise ValueError("compression_reserved_concurrency must be at least 2")
+        return v
+
+    @field_validator("compression_timeout_seconds")
+    @classmethod
+    def validate_lambda_timeout(cls, v: int) -> int:
+        # The queue's visibility timeout is six times this, at most 12 hours
+        if not 1 <= v <= 900:
+            raise ValueError("compression_timeout_seconds must be 1-900")
+        return v
+
+
+PERFORMANCE_PROFILES: Dict[str, PerformanceProfile] = {
+    "dev": PerformanceProfile(
+        fargate_max_tasks=1,
+        aurora_max_acu=1,
+        aurora_auto_pause_minutes=10,
+        compression_reserved_concurrency=2,
+        worker_cpu=1024,
+        worker_memory_mib=4096,
+        worker_max_tasks=1,
+        worker_max_megapixels=150,
+    ),
+    "staging": PerformanceProfile(),
+    "prod-high": PerformanceProfile(
+        availability_zones=3,
+        fargate_cpu=1024,
+        fargate_memory_mib=4096,
+        fargate_min_tasks=2,
+        fargate_max_tasks=10,
+        aurora_min_acu=2,
+        aurora_max_acu=16,
+        compression_memory_mb=2048,
+        compression_timeout_seconds=60,
+        compression_max_megapixels=40,
+        transform_memory_mb=2048,
+        transform_max_megapixels=150,
+        transform_provisioned_concurrency=2,
+        worker_cpu=4096,
+        worker_memory_mib=16384,
+        worker_max_tasks=4,
+        worker_max_megapixels=600,
+    ),
+}
+
+
 class Settings(BaseSettings):
     model_config = SettingsConfigDict(env_file=".env")
 
@@ -34,8 +197,9 @@ class Settings(BaseSettings):
         .replace("_", "")
     )
 
+    # POSTGRES_HOST is not mapped from the secret: tasks are pointed at the
+    # RDS Proxy endpoint rather than the cluster endpoint stored there
     DB_SECRET_MAPPING: Dict[str, str] = {
-        "POSTGRES_HOST": "host",
         "POSTGRES_PORT": "port",
         "POSTGRES_USER": "username",
         "POSTGRES_PASSWORD": "password",
@@ -44,6 +208,252 @@ class Settings(BaseSettings):
 
     CDK_DEFAULT_ACCOUNT: str
 
+    # Cluster snapshot the Aurora cluster is restored from instead of being
+    # created empty; once set, leave it set, as changing or removing it replaces
+    # the cluster again
+    AURORA_SNAPSHOT_IDENTIFIER: Optional[str] = None
+
+    DB_PROXY_MAX_CONNECTIONS_PERCENT: int = 90
+    DB_PROXY_IDLE_CLIENT_TIMEOUT_MINUTES: int = 30
+    DB_PROXY_BORROW_TIMEOUT_SECONDS: int = 30
+
+    # Image CDN TTLs: compressed outputs are immutable and cached for the max
+    # TTL, anything without a Cache-Control header for the default TTL
+    IMAGE_CDN_DEFAULT_TTL_SECONDS: int = 60
+    IMAGE_CDN_MAX_TTL_DAYS: int = 365
+
+    # Datadog: the app reaches the sidecar agent over Unix sockets on a shared
+    # volume instead of TCP. The tracer keeps DATADOG_TRACE_SAMPLE_RATE of
+    # traces up to DATADOG_TRACE_RATE_LIMIT per second, the agent forwards at
+    # most DATADOG_APM_MAX_TPS; DogStatsD clients aggregate in process and
+    # flush every DATADOG_STATSD_FLUSH_INTERVAL_SECONDS
+    DATADOG_TRACE_SAMPLE_RATE: float = 0.1
+    DATADOG_TRACE_RATE_LIMIT: int = 100
+    DATADOG_APM_MAX_TPS: int = 10
+    DATADOG_STATSD_FLUSH_INTERVAL_SECONDS: float = 10.0
+    DATADOG_PROFILING_ENABLED: bool = False
+    DATADOG_RUNTIME_METRICS_ENABLED: bool = True
+    # The sidecar gets its own CPU and memory reservation and a hard memory
+    # limit, capped at DATADOG_MAX_TASK_SHARE of the profile's task size. Its
+    # actual usage is reported per container as ecs.fargate.cpu.percent /
+    # ecs.fargate.mem.usage (container_name tag) through ECS_FARGATE_METRICS
+    DATADOG_MAX_TASK_SHARE: float = 0.15
+    DATADOG_AGENT_CPU: int = 64
+    DATADOG_AGENT_MEMORY_RESERVATION_MIB: int = 128
+    DATADOG_AGENT_MEMORY_LIMIT_MIB: int = 256
+
+    # Fargate service autoscaling between the profile's task counts: target
+    # tracking on ALB requests per task (per minute) and on CPU, whichever asks
+    # for more tasks wins
+    FARGATE_TARGET_REQUESTS_PER_TASK: int = 600
+    FARGATE_TARGET_CPU_PERCENT: int = 60
+    FARGATE_SCALE_OUT_COOLDOWN_SECONDS: int = 30
+    FARGATE_SCALE_IN_COOLDOWN_SECONDS: int = 300
+
+    # ALB target group: short drains and health checks so new tasks receive
+    # traffic quickly; slow start ramps a new task's share (0 disables it)
+    ALB_DEREGISTRATION_DELAY_SECONDS: int = 30
+    ALB_SLOW_START_SECONDS: int = 30
+    ALB_HEALTH_CHECK_INTERVAL_SECONDS: int = 10
+    ALB_HEALTHY_THRESHOLD_COUNT: int = 2
+
+    # Public, anonymous GET routes cached briefly at the edge, mapped to the
+    # query strings that select their response, e.g.
+    # {"/api/v1/posts/public*": ["page", "limit"]}. These paths only accept
+    # GET and HEAD; requests with an Authorization header and everything else
+    # under /api/* stay uncached
+    API_CACHEABLE_PATHS: Dict[str, List[str]] = {}
+    API_CACHE_DEFAULT_TTL_SECONDS: int = 5
+    API_CACHE_MAX_TTL_SECONDS: int = 60
+
+    # Fingerprinted build output directory inside web/dist, deployed immutable;
+    # everything else (index.html, ...) is cached for FRONTEND_HTML_MAX_AGE_SECONDS
+    FRONTEND_ASSETS_PREFIX: str = "assets"
+    FRONTEND_HTML_MAX_AGE_SECONDS: int = 60
+    # Bundles a deploy no longer references are deleted this many days later
+    FRONTEND_ASSETS_GRACE_DAYS: int = 7
+
+    # On-demand variants are served at /<prefix>/<width>/<format>/<quality>/<key>
+    # on the image CDNs, for the widths listed here only, and kept in each
+    # bucket under the variant prefix
+    IMAGE_TRANSFORM_PATH_PREFIX: str = "t"
+    IMAGE_TRANSFORM_WIDTHS: List[int] = [160, 320, 480, 640, 960, 1280, 1920]
+    IMAGE_TRANSFORM_QUALITIES: List[int] = [50, 70, 85]
+    IMAGE_TRANSFORM_VARIANT_PREFIX: str = "_variants"
+    # Sources over this size are refused by the transform function unread
+    IMAGE_TRANSFORM_MAX_BYTES: int = 100 * 1024 * 1024
+
+    # The compression Lambda writes every output under this prefix and leaves
+    # the upload untouched; the image CDNs serve /<key> from <prefix>/<key>
+    COMPRESSION_OUTPUT_PREFIX: str = "_compressed"
+    # S3 notification filters cannot exclude a prefix, so uploads are
+    # subscribed one leading character at a time. The output and variant
+    # prefixes must start with a character outside this set, and uploads with
+    # a key starting outside it are never compressed
+    COMPRESSION_UPLOAD_KEY_INITIALS: str = string.ascii_letters + string.digits
+
+    # Long-edge sizes (px) of the renditions the compression Lambda produces
+    COMPRESSION_RENDITION_SIZES: List[int] = [1080, 480, 160]
+    # Long-edge cap (px) for the full-size output; 0 keeps the source dimensions
+    COMPRESSION_MAX_LONG_EDGE: int = 0
+    # Formats written next to every JPEG, in order of preference when the image
+    # CDNs negotiate on the Accept header; add "avif" to opt in
+    COMPRESSION_EXTRA_FORMATS: List[str] = ["webp"]
+    # "fixed", "ssim" (lowest quality reaching COMPRESSION_TARGET_SSIM) or
+    # "bytes" (highest quality within COMPRESSION_MAX_BYTES for the full size)
+    COMPRESSION_QUALITY_MODE: Literal["fixed", "ssim", "bytes"] = "fixed"
+    COMPRESSION_TARGET_SSIM: float = 0.95
+    COMPRESSION_MAX_BYTES: int = 0
+    # Progressive JPEG with optimized Huffman tables: ~16% smaller on the
+    # benchmark corpus, for ~15 ms more encode time per 2048px image
+    COMPRESSION_PROGRESSIVE_JPEG: bool = True
+    # "blurhash" stores a BlurHash placeholder in every output's metadata
+    # (x-amz-meta-blurhash); "" disables it
+    COMPRESSION_PLACEHOLDER: str = "blurhash"
+    # Write <key>.manifest.json (dimensions, bytes, renditions, content hash,
+    # placeholder) for every image and queue it for the backend to ingest
+    COMPRESSION_MANIFEST: bool = True
+    # Receives of a manifest message before it moves to the manifest DLQ
+    COMPRESSION_MANIFEST_MAX_RECEIVE_COUNT: int = 5
+    # How long a content hash stays in the dedup index after its outputs are
+    # produced; re-uploads within this window are served by server-side copies
+    COMPRESSION_DEDUP_TTL_DAYS: int = 30
+    # Spool bodies through /tmp, decode JPEGs in draft mode and upload through
+    # multipart instead of buffering everything in memory
+    COMPRESSION_STREAMING: bool = True
+    # S3 notifications are queued and handed to the Lambda in batches; records
+    # in a batch are processed by COMPRESSION_BATCH_WORKERS threads
+    COMPRESSION_BATCH_SIZE: int = 10
+    COMPRESSION_BATCH_WINDOW_SECONDS: int = 5
+    COMPRESSION_BATCH_WORKERS: int = 4
+    # Uploads over this size, or over the profile's compression megapixels, skip
+    # the Lambda and go to a Fargate worker running the same code with more
+    # memory and no Lambda timeout
+    COMPRESSION_LAMBDA_MAX_BYTES: int = 20 * 1024 * 1024
+    # Messages a worker receives at once, and the threads processing them
+    COMPRESSION_WORKER_BATCH_SIZE: int = 2
+    COMPRESSION_WORKER_BATCH_WORKERS: int = 2
+    # Deliveries of a failing message before it is moved to the dead-letter
+    # queue; undecodable images are quarantined on the first
+    COMPRESSION_MAX_RECEIVE_COUNT: int = 3
+
+    # Capacity of every stack comes from one of PERFORMANCE_PROFILES; declared
+    # last so its validator can check the profile against the settings above
+    PERFORMANCE_PROFILE: Literal["dev", "staging", "prod-high"] = "staging"
+
+    @property
+    def profile(self) -> PerformanceProfile:
+        return PERFORMANCE_PROFILES[self.PERFORMANCE_PROFILE]
+
+    @field_validator("DATADOG_TRACE_SAMPLE_RATE")
+    @classmethod
+    def validate_datadog_sample_rate(cls, v: float) -> float:
+        if not 0 <= v <= 1:
+            raise ValueError("DATADOG_TRACE_SAMPLE_RATE must be between 0 and 1")
+        return v
+
+    @field_validator("DATADOG_AGENT_MEMORY_LIMIT_MIB")
+    @classmethod
+    def validate_datadog_agent_memory(cls, v: int, info: ValidationInfo) -> int:
+        if v < info.data.get("DATADOG_AGENT_MEMORY_RESERVATION_MIB", 0):
+            raise ValueError(
+                "DATADOG_AGENT_MEMORY_LIMIT_MIB must be at least the reservation"
+            )
+        return v
+
+    @field_validator("PERFORMANCE_PROFILE")
+    @classmethod
+    def validate_performance_profile(cls, v: str, info: ValidationInfo) -> str:
+        profile = PERFORMANCE_PROFILES[v]
+
+        share = info.data.get("DATADOG_MAX_TASK_SHARE", 0)
+        if info.data.get("DATADOG_AGENT_CPU", 0) > profile.fargate_cpu * share:
+            raise ValueError(
+                f"{v}: DATADOG_AGENT_CPU exceeds DATADOG_MAX_TASK_SHARE of the task"
+            )
+        if info.data.get("DATADOG_AGENT_MEMORY_LIMIT_MIB", 0) > (
+            profile.fargate_memory_mib * share
+        ):
+            raise ValueError(
+                f"{v}: DATADOG_AGENT_MEMORY_LIMIT_MIB exceeds DATADOG_MAX_TASK_SHARE of the task"
+            )
+
+        # Every batch worker thread may be decoding the largest image at once
+        compression_memory = image_memory_mb(
+            profile.compression_max_megapixels,
+            info.data.get("COMPRESSION_BATCH_WORKERS", 1),
+        )
+        if profile.compression_memory_mb < compression_memory:
+            raise ValueError(
+                f"{v}: compression_memory_mb is below the {compression_memory} MB "
+                f"needed for {profile.compression_max_megapixels} MP images"
+            )
+        # A transform instance serves one request at a time
+        transform_memory = image_memory_mb(profile.transform_max_megapixels, 1)
+        if profile.transform_memory_mb < transform_memory:
+            raise ValueError(
+                f"{v}: transform_memory_mb is below the {transform_memory} MB "
+                f"needed for {profile.transform_max_megapixels} MP images"
+            )
+        worker_memory = image_memory_mb(
+            profile.worker_max_megapixels,
+            info.data.get("COMPRESSION_WORKER_BATCH_WORKERS", 1),
+        )
+        if profile.worker_memory_mib < worker_memory:
+            raise ValueError(
+                f"{v}: worker_memory_mib is below the {worker_memory} MiB needed "
+                f"for {profile.worker_max_megapixels} MP images"
+            )
+        return v
+
+    @field_validator("COMPRESSION_TARGET_SSIM")
+    @classmethod
+    def validate_compression_target_ssim(cls, v: float, info: ValidationInfo) -> float:
+        if info.data.get("COMPRESSION_QUALITY_MODE") == "ssim" and not 0 < v <= 1:
+            raise ValueError("COMPRESSION_TARGET_SSIM must be in (0, 1] in ssim mode")
+        return v
+
+    @field_validator("COMPRESSION_MAX_BYTES")
+    @classmethod
+    def validate_compression_max_bytes(cls, v: int, info: ValidationInfo) -> int:
+        # A zero budget would make every image fall to the lowest quality
+        if info.data.get("COMPRESSION_QUALITY_MODE") == "bytes" and v <= 0:
+            raise ValueError("COMPRESSION_MAX_BYTES must be positive in bytes mode")
+        return v
+
+    @field_validator("COMPRESSION_UPLOAD_KEY_INITIALS")
+    @classmethod
+    def validate_compression_upload_key_initials(
+        cls, v: str, info: ValidationInfo
+    ) -> str:
+        if not v or len(set(v)) != len(v):
+            raise ValueError(
+                "COMPRESSION_UPLOAD_KEY_INITIALS must be distinct characters"
+            )
+        for name in ["COMPRESSION_OUTPUT_PREFIX", "IMAGE_TRANSFORM_VARIANT_PREFIX"]:
+            prefix = info.data.get(name, "")
+            if not prefix or prefix[0] in v:
+                raise ValueError(
+                    f"{name} must start with a character outside "
+                    "COMPRESSION_UPLOAD_KEY_INITIALS, or its objects are compressed"
+                )
+        return v
+
+    @field_validator("COMPRESSION_WORKER_BATCH_SIZE")
+    @classmethod
+    def validate_compression_worker_batch_size(cls, v: int) -> int:
+        # SQS returns at most 10 messages per receive
+        if not 1 <= v <= 10:
+            raise ValueError("COMPRESSION_WORKER_BATCH_SIZE must be between 1 and 10")
+        return v
+
+    @field_validator("ALB_SLOW_START_SECONDS")
+    @classmethod
+    def validate_alb_slow_start(cls, v: int) -> int:
+        if v and not 30 <= v <= 900:
+            raise ValueError("ALB_SLOW_START_SECONDS must be 0 or 30-900")
+        return v
+
     @field_validator("SUNET_DNS_ROOT", mode="before")
     @classmethod
     def assemble_sunet_dns_root(cls, v: Optional[str], info: ValidationInfo) -> str:
@@ -67,8 +477,10 @@ class Props:
     network_backend_certificate: acm.ICertificate
     network_frontend_certificate: acm.ICertificate
     network_hosted_zone: r53.IHostedZone
-    data_aurora_db: rds.ServerlessCluster
+    data_aurora_db: Union[rds.DatabaseCluster, rds.DatabaseClusterFromSnapshot]
+    data_db_proxy: rds.DatabaseProxy
     data_s3_public_images: s3.Bucket
     data_s3_private_images: s3.Bucket
     data_cloudfront_public_images: cloudfront.Distribution
     data_cloudfront_private_images: cloudfront.Distribution
+    data_manifest_queue: sqs.Queue
@@ -0,0 +1,83 @@
+"""Custom resource that starts the grace period of frontend bundles a deploy
+no longer references.
+
+Every object under Prefix that is not in Keys and not yet retired is copied
+onto itself with the retired tag. The copy restarts the object's age, so the
+bucket's lifecycle rule on that tag deletes it a grace period after it stopped
+being current instead of after its first upload.
+
+A retired bundle that a later deploy references again keeps its tag through
+that deploy, since the sync skips objects whose content has not changed. So
+every key in Keys that carries the tag has it removed here.
+"""
+import logging
+from typing import Any, Dict, List
+
+import boto3
+
+RETIRED_TAG = "retired"
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+s3_client = boto3.client("s3")
+
+
+def retire(bucket: str, key: str) -> None:
+    head = s3_client.head_object(Bucket=bucket, Key=key)
+    # Copying an object onto itself needs REPLACE, so carry everything over
+    s3_client.copy_object(
+        Bucket=bucket,
+        Key=key,
+        CopySource={"Bucket": bucket, "Key": key},
+        CopySourceIfMatch=head["ETag"],
+        MetadataDirective="REPLACE",
+        Metadata=head["Metadata"],
+        **{
+            name: head[name]
+            for name in ["ContentType", "CacheControl", "ContentEncoding"]
+            if name in head
+        },
+        TaggingDirective="REPLACE",
+        Tagging=f"{RETIRED_TAG}=true",
+    )
+
+
+def restore(bucket: str, key: str, tags: List[Dict[str, str]]) -> None:
+    # Tagging does not create a new object version or change its age
+    s3_client.put_object_tagging(
+        Bucket=bucket,
+        Key=key,
+        Tagging={"TagSet": [tag for tag in tags if tag["Key"] != RETIRED_TAG]},
+    )
+
+
+def handler(event: Dict[str, Any], _: Any) -> Dict[str, Any]:
+    if event["RequestType"] == "Delete":
+        return {}
+
+    properties = event["ResourceProperties"]
+    bucket = properties["Bucket"]
+    current = set(properties["Keys"])
+
+    retired = restored = 0
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=properties["Prefix"]):
+        for entry in page.get("Contents", []):
+            key = entry["Key"]
+            tags = s3_client.get_object_tagging(Bucket=bucket, Key=key)["TagSet"]
+            is_retired = any(tag["Key"] == RETIRED_TAG for tag in tags)
+            if key in current and is_retired:
+                restore(bucket, key, tags)
+                restored += 1
+            elif key not in current and not is_retired:
+                retire(bucket, key)
+                retired += 1
+
+    logger.info(
+        "retired %d and restored %d objects under %s",
+        retired,
+        restored,
+        properties["Prefix"],
+    )
+    return {"Data": {"Retired": retired, "Restored": restored}}
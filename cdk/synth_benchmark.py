@@ -0,0 +1,75 @@
+"""Time `cdk synth` of this app phase by phase.
+
+Reports aws_cdk and app import time, construct time per stack, assembly
+write time and per-stack template size as JSON, so iteration speed can be
+compared across commits:
+
+    python synth_benchmark.py [--stacks data,compute] [--output synth.json]
+
+Needs the same environment as `cdk synth` (SUNET, CDK_DEFAULT_ACCOUNT).
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+start = time.perf_counter()
+import aws_cdk as cdk  # noqa: E402
+
+aws_cdk_import_seconds = time.perf_counter() - start
+
+start = time.perf_counter()
+import app as cdk_app  # noqa: E402
+
+app_import_seconds = time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stacks", help="comma-separated stacks, default all")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    outdir = tempfile.mkdtemp(prefix="synth-benchmark-")
+    app = cdk.App(outdir=outdir, context={"stacks": args.stacks} if args.stacks else {})
+
+    construct_seconds = {}
+    cdk_app.build(
+        app,
+        cdk_app.selected_stacks(app),
+        on_stack=lambda name, seconds: construct_seconds.update({name: seconds}),
+    )
+
+    start = time.perf_counter()
+    assembly = app.synth()
+    synth_seconds = time.perf_counter() - start
+
+    report = json.dumps(
+        {
+            "import_seconds": {
+                "aws_cdk": round(aws_cdk_import_seconds, 3),
+                "app": round(app_import_seconds, 3),
+            },
+            "construct_seconds": {
+                name: round(seconds, 3) for name, seconds in construct_seconds.items()
+            },
+            # CDK resolves and writes every template of the assembly in one pass
+            "synth_seconds": round(synth_seconds, 3),
+            "template_bytes": {
+                stack.stack_name: os.path.getsize(stack.template_full_path)
+                for stack in assembly.stacks
+            },
+        },
+        indent=2,
+    )
+    shutil.rmtree(outdir)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report + "\n")
+
+
+if __name__ == "__main__":
+    main()
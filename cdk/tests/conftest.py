@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Appended, so the compression suite's app module is not shadowed by cdk/app.py
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,83 @@
+import json
+import os
+
+import pytest
+
+from cdk import policy_check
+
+
+def write_template(cdk_out, stack, resources):
+    path = os.path.join(cdk_out, f"yoctogram-{stack}-stack.template.json")
+    with open(path, "w") as template:
+        json.dump({"Resources": resources}, template)
+    return path
+
+
+@pytest.fixture
+def cdk_out(tmp_path):
+    for stack in policy_check.DEFAULT_STACKS:
+        write_template(
+            tmp_path,
+            stack,
+            {f"{stack}Bucket": {"Type": "AWS::S3::Bucket"}, "CDKMetadata": {}},
+        )
+    rules = tmp_path / "rules"
+    rules.mkdir()
+    (rules / "main.rego").write_text("package rules.main\n")
+    return tmp_path
+
+
+@pytest.fixture
+def evaluations(monkeypatch):
+    calls = []
+
+    def evaluate(merged_path, rules_dir):
+        with open(merged_path) as merged:
+            calls.append(json.load(merged))
+        return [f"violation {len(calls)}"]
+
+    monkeypatch.setattr(policy_check, "evaluate", evaluate)
+    return calls
+
+
+def check(cdk_out):
+    return policy_check.check(
+        str(cdk_out), str(cdk_out / "rules"), "yoctogram", policy_check.DEFAULT_STACKS
+    )
+
+
+def test_merges_resources_without_cdk_metadata(cdk_out, evaluations):
+    assert check(cdk_out) == ["violation 1"]
+    assert evaluations == [
+        {
+            "Resources": {
+                "networkBucket": {"Type": "AWS::S3::Bucket"},
+                "dataBucket": {"Type": "AWS::S3::Bucket"},
+                "computeBucket": {"Type": "AWS::S3::Bucket"},
+            }
+        }
+    ]
+
+
+def test_unchanged_tree_is_not_reevaluated(cdk_out, evaluations):
+    assert check(cdk_out) == check(cdk_out) == ["violation 1"]
+    assert len(evaluations) == 1
+
+    write_template(cdk_out, "data", {"dataQueue": {"Type": "AWS::SQS::Queue"}})
+    (cdk_out / "rules" / "main.rego").write_text("package rules.main\n# changed\n")
+    assert check(cdk_out) == ["violation 2"]
+
+
+def test_cache_keeps_only_recent_entries(cdk_out, evaluations, monkeypatch):
+    monkeypatch.setattr(policy_check, "CACHE_ENTRIES", 2)
+    for version in range(4):
+        write_template(cdk_out, "data", {f"dataQueue{version}": {}})
+        check(cdk_out)
+
+    cached = sorted(os.listdir(cdk_out / policy_check.CACHE_DIR_NAME))
+    assert len([name for name in cached if name.startswith("input-")]) == 2
+    assert len([name for name in cached if name.startswith("result-")]) == 2
+
+    # The latest input is still cached
+    check(cdk_out)
+    assert len(evaluations) == 4
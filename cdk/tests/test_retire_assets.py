@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+# The handler creates its S3 client at import
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-2")
+
+from handlers import retire_assets  # noqa: E402
+
+
+class FakeS3:
+    def __init__(self, tags):
+        self.tags = tags
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        return [{"Contents": [{"Key": key} for key in sorted(self.tags)]}]
+
+    def get_object_tagging(self, Bucket, Key):
+        return {"TagSet": [{"Key": k, "Value": v} for k, v in self.tags[Key].items()]}
+
+    def put_object_tagging(self, Bucket, Key, Tagging):
+        self.tags[Key] = {tag["Key"]: tag["Value"] for tag in Tagging["TagSet"]}
+
+    def head_object(self, Bucket, Key):
+        return {"ETag": '"etag"', "Metadata": {}, "ContentType": "text/javascript"}
+
+    def copy_object(self, Bucket, Key, Tagging, **_):
+        self.tags[Key] = dict(tag.split("=", 1) for tag in Tagging.split("&"))
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    client = FakeS3(
+        {
+            "assets/current.js": {},
+            "assets/old.js": {},
+            "assets/gone.js": {"retired": "true"},
+            "assets/back.js": {"retired": "true", "team": "web"},
+        }
+    )
+    monkeypatch.setattr(retire_assets, "s3_client", client)
+    return client
+
+
+def deploy(keys):
+    return retire_assets.handler(
+        {
+            "RequestType": "Update",
+            "ResourceProperties": {"Bucket": "frontend", "Prefix": "assets/", "Keys": keys},
+        },
+        None,
+    )
+
+
+def test_unreferenced_bundles_are_retired_and_referenced_ones_restored(s3):
+    response = deploy(["assets/current.js", "assets/back.js"])
+
+    assert response == {"Data": {"Retired": 1, "Restored": 1}}
+    assert s3.tags == {
+        "assets/current.js": {},
+        "assets/old.js": {"retired": "true"},
+        "assets/gone.js": {"retired": "true"},
+        "assets/back.js": {"team": "web"},
+    }
+
+
+def test_delete_leaves_the_bucket_alone(s3):
+    assert retire_assets.handler({"RequestType": "Delete"}, None) == {}
+    assert s3.tags["assets/old.js"] == {}
@@ -1,46 +1,764 @@
+import hashlib
+import importlib
+import json
+import logging
+import math
+import os
+import resource
+import struct
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from io import BytesIO
-from typing import TYPE_CHECKING
+from tempfile import SpooledTemporaryFile
+from typing import IO, TYPE_CHECKING, Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+from urllib.parse import quote_plus, unquote_plus
 
+from aws_lambda_powertools import Metrics
+from aws_lambda_powertools.metrics import MetricUnit
 from aws_lambda_powertools.utilities.typing import LambdaContext
-from aws_lambda_powertools.utilities.data_classes import event_source, S3Event
+from aws_lambda_powertools.utilities.data_classes import (
+    event_source,
+    S3Event,
+    SQSEvent,
+)
+from aws_lambda_powertools.utilities.data_classes.sqs_event import SQSRecord
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
 if TYPE_CHECKING:
+    from botocore.response import StreamingBody
+    from mypy_boto3_dynamodb import DynamoDBClient
     from mypy_boto3_s3 import S3Client
+    from mypy_boto3_sqs import SQSClient
 
-from PIL import Image
+from PIL import Image, UnidentifiedImageError, features
 
+import placeholder
+import quality
 
-@event_source(data_class=S3Event)
-def handler(event: S3Event, _: LambdaContext) -> None:
-    s3_client: S3Client = boto3.client("s3")
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
 
-    bucket = event.bucket_name
-    key = event.object_key
+# Namespace and service come from POWERTOOLS_METRICS_NAMESPACE and
+# POWERTOOLS_SERVICE_NAME. Metrics are buffered for the whole invocation and
+# flushed as a single EMF log line by log_metrics
+metrics = Metrics()
+metrics_lock = threading.Lock()
 
-    tag_response = s3_client.get_object_tagging(Bucket=bucket, Key=key)
-    compression_tag = [
-        pair for pair in tag_response["TagSet"] if pair["Key"] == "compressed"
-    ]
-    if len(compression_tag) > 0 and compression_tag[0]["Value"] == "true":
-        return
+JPEG_QUALITY = 30
+
+# Progressive scans with optimized Huffman tables: the image paints coarse-to-
+# fine as it downloads, and is usually a few percent smaller than baseline
+PROGRESSIVE_JPEG = os.environ.get("PROGRESSIVE_JPEG", "false").lower() == "true"
+
+# Content type and save() options for each output format. JPEG is always
+# written as the fallback; the others are written next to it as <jpeg key>.<ext>
+ENCODERS: Dict[str, Tuple[str, Dict[str, Any]]] = {
+    "jpeg": (
+        "image/jpeg",
+        {
+            "quality": JPEG_QUALITY,
+            "progressive": PROGRESSIVE_JPEG,
+            "optimize": PROGRESSIVE_JPEG,
+        },
+    ),
+    "webp": ("image/webp", {"quality": 30, "method": 4}),
+    "avif": ("image/avif", {"quality": 40, "speed": 6}),
+}
+EXTRA_FORMATS = [
+    format
+    for format in os.environ.get("EXTRA_FORMATS", "").split(",")
+    if format in ENCODERS and features.check(format)
+]
+
+# "fixed" uses the qualities above; "ssim" picks the lowest quality per image and
+# format that reaches TARGET_SSIM, "bytes" the highest that keeps the full-size
+# output within MAX_BYTES. Both search on a small proxy of the image
+QUALITY_MODE = os.environ.get("QUALITY_MODE", "fixed")
+TARGET_SSIM = float(os.environ.get("TARGET_SSIM", "0.95"))
+MAX_BYTES = int(os.environ.get("MAX_BYTES", "0"))
+if QUALITY_MODE not in {"fixed", "ssim", "bytes"}:
+    raise ValueError(f"unknown QUALITY_MODE {QUALITY_MODE!r}")
+if QUALITY_MODE == "bytes" and MAX_BYTES <= 0:
+    raise ValueError("QUALITY_MODE=bytes needs a positive MAX_BYTES")
+
+# "blurhash" stores a BlurHash of the image in every output's metadata so
+# clients can paint a placeholder before the image arrives; "" disables it
+PLACEHOLDER = os.environ.get("PLACEHOLDER", "")
+
+# MANIFEST writes <key>.manifest.json next to the outputs, describing them so
+# the backend never has to HEAD them, and sends the same document, with bucket
+# and key added, to MANIFEST_QUEUE_URL for bulk ingest into the database
+MANIFEST = os.environ.get("MANIFEST", "false").lower() == "true"
+MANIFEST_SUFFIX = ".manifest.json"
+MANIFEST_QUEUE_URL = os.environ.get("MANIFEST_QUEUE_URL", "")
+
+# Outputs are never rewritten in place, so browsers and the CDN may keep them
+CACHE_CONTROL = os.environ.get(
+    "CACHE_CONTROL", "public, max-age=31536000, immutable"
+)
+
+# Every output is written under OUTPUT_PREFIX/<key>, so the upload itself stays
+# untouched as the original the transform function resizes from, and the
+# prefix can be left out of the bucket notifications
+OUTPUT_PREFIX = os.environ.get("OUTPUT_PREFIX", "_compressed")
+
+# Stamped on every object this function writes so an S3 event for one of them
+# can be recognised from the GetObject response headers alone. The bucket
+# notifications already leave OUTPUT_PREFIX out; this catches anything else
+COMPRESSED_METADATA = {"compressed": "true"}
+
+# Long-edge sizes (px) to produce for every upload, e.g. "1080,480,160"
+RENDITION_SIZES = sorted(
+    (int(size) for size in os.environ.get("RENDITION_SIZES", "").split(",") if size),
+    reverse=True,
+)
+
+# Long-edge cap (px) for the full-size output; 0 keeps
+# the source dimensions
+MAX_LONG_EDGE = int(os.environ.get("MAX_LONG_EDGE", "0"))
+
+# Streaming mode spools the S3 body and the encoded outputs through temporary
+# files instead of holding them in memory, and uploads through multipart
+STREAMING = os.environ.get("STREAMING", "false").lower() == "true"
+STREAM_CHUNK_SIZE = 1024 * 1024
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=SPOOL_MAX_SIZE,
+    multipart_chunksize=SPOOL_MAX_SIZE,
+    max_concurrency=4,
+)
+
+# Records in an SQS batch are processed concurrently; Pillow releases the GIL
+# while decoding, resizing and encoding, so threads overlap both S3 I/O and
+# image work
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", "4"))
+
+# Objects over ROUTE_MAX_BYTES or ROUTE_MAX_PIXELS are not processed here but
+# forwarded to LARGE_QUEUE_URL, which the Fargate worker consumes; 0 disables
+# either check. Unset in the worker itself
+LARGE_QUEUE_URL = os.environ.get("LARGE_QUEUE_URL", "")
+ROUTE_MAX_BYTES = int(os.environ.get("ROUTE_MAX_BYTES", "0"))
+ROUTE_MAX_PIXELS = int(os.environ.get("ROUTE_MAX_PIXELS", "0"))
+
+# Created once per container so warm invocations reuse resolved credentials,
+# endpoint data and kept-alive connections; sized so every worker thread's
+# multipart parts get a pooled connection
+s3_client: "S3Client" = boto3.client(
+    "s3",
+    config=Config(
+        max_pool_connections=BATCH_WORKERS * TRANSFER_CONFIG.max_request_concurrency,
+        tcp_keepalive=True,
+        retries={"mode": "standard"},
+    ),
+)
+
+# Identical uploads are served by copying the outputs already produced for the
+# same bytes. DEDUP_TABLE maps content hash to the key those outputs live
+# under; entries expire after DEDUP_TTL_DAYS through DynamoDB TTL
+DEDUP_TABLE = os.environ.get("DEDUP_TABLE", "")
+DEDUP_TTL_DAYS = int(os.environ.get("DEDUP_TTL_DAYS", "30"))
+dynamodb_client: Optional["DynamoDBClient"] = (
+    boto3.client("dynamodb", config=Config(tcp_keepalive=True)) if DEDUP_TABLE else None
+)
+sqs_client: Optional["SQSClient"] = (
+    boto3.client("sqs", config=Config(tcp_keepalive=True))
+    if LARGE_QUEUE_URL or MANIFEST_QUEUE_URL
+    else None
+)
+
+# Register only the Pillow plugins for formats we read or write. Passing
+# INPUT_FORMATS to Image.open also stops Pillow from importing every other
+# plugin when it meets an unrecognised file
+PLUGINS = {
+    "JPEG": "JpegImagePlugin",
+    "PNG": "PngImagePlugin",
+    "GIF": "GifImagePlugin",
+    "WEBP": "WebPImagePlugin",
+    "AVIF": "AvifImagePlugin",
+}
+INPUT_FORMATS = ["JPEG", "PNG", "GIF", "WEBP"]
+if features.check("avif"):
+    INPUT_FORMATS.append("AVIF")
+for plugin in {PLUGINS[format.upper()] for format in ["jpeg", *EXTRA_FORMATS]} | {
+    PLUGINS[format] for format in INPUT_FORMATS
+}:
+    importlib.import_module(f"PIL.{plugin}")
+
+
+# Sources over MAX_PIXELS fail in Image.open, from the header alone, instead of
+# only raising a warning (Pillow's default) until twice its own limit
+MAX_PIXELS = int(os.environ.get("MAX_PIXELS", "0"))
+if MAX_PIXELS:
+    Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+warnings.simplefilter("error", Image.DecompressionBombWarning)
+
+# Errors caused by the file itself rather than by S3 or the runtime; the object
+# is tagged and its message dropped, since every retry would fail the same way
+POISON_ERRORS = (
+    UnidentifiedImageError,
+    Image.DecompressionBombError,
+    Image.DecompressionBombWarning,
+)
+# What Pillow's parsers and decoders raise on malformed data. These only count
+# as poison when raised while opening or decoding, and OSError only without an
+# errno: with one it came from the system (ENOSPC, EIO, ...), not the file
+DECODER_ERRORS = (OSError, SyntaxError, ValueError, EOFError, struct.error)
+QUARANTINE_TAG = "quarantine"
+
+
+class Output(NamedTuple):
+    key: str
+    buffer: IO[bytes]
+    size: int
+    content_type: str
+    metadata: Dict[str, str]
+    width: int
+    height: int
+
+
+def add_metric(name: str, unit: MetricUnit, value: float) -> None:
+    # Records are processed on worker threads; Metrics itself is not
+    # thread-safe when two threads add the first value of a metric
+    with metrics_lock:
+        metrics.add_metric(name=name, unit=unit, value=value)
+
+
+@contextmanager
+def timed(phase: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_metric(
+            f"{phase}Duration",
+            MetricUnit.Milliseconds,
+            (time.perf_counter() - start) * 1000,
+        )
+
+
+def output_key(key: str) -> str:
+    return f"{OUTPUT_PREFIX}/{key}"
+
+
+def rendition_key(key: str, size: int) -> str:
+    return f"{key}.{size}.jpg"
 
-    object = s3_client.get_object(Bucket=bucket, Key=key)
-    body = object["Body"].read()
 
-    image_buffer = BytesIO()
+def variant_key(jpeg_key: str, format: str) -> str:
+    return f"{jpeg_key}.{format}"
 
-    with Image.open(BytesIO(body)) as image_orig:
-        image_orig.save(image_buffer, format="jpeg", quality=30)
 
+def new_buffer() -> IO[bytes]:
+    if STREAMING:
+        return SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    return BytesIO()
+
+
+def encode(image: Image.Image, format: str, format_quality: int) -> IO[bytes]:
+    # WebP and AVIF keep the alpha channel; JPEG has none
+    if format == "jpeg":
+        image = flatten(image)
+    image_buffer = new_buffer()
+    image.save(
+        image_buffer,
+        format=format,
+        **{**ENCODERS[format][1], "quality": format_quality},
+    )
     image_buffer.seek(0)
+    return image_buffer
+
+
+def choose_qualities(image: Image.Image) -> Dict[str, int]:
+    qualities = {
+        format: ENCODERS[format][1]["quality"] for format in ["jpeg", *EXTRA_FORMATS]
+    }
+    if QUALITY_MODE == "fixed":
+        return qualities
+
+    # Bytes scale roughly with pixel count, so the budget for the full-size
+    # output becomes a bits-per-pixel budget for the proxy
+    proxy = quality.make_proxy(image)
+    max_bits_per_pixel = MAX_BYTES * 8 / (image.width * image.height)
+
+    for format in qualities:
+        qualities[format] = quality.choose_quality(
+            flatten(proxy) if format == "jpeg" else proxy,
+            format,
+            ENCODERS[format][1],
+            target_ssim=TARGET_SSIM if QUALITY_MODE == "ssim" else 0.0,
+            max_bits_per_pixel=max_bits_per_pixel if QUALITY_MODE == "bytes" else 0.0,
+        )
+
+    return qualities
+
+
+def encode_all(
+    image: Image.Image,
+    jpeg_key: str,
+    qualities: Dict[str, int],
+    source_bytes: int,
+    metadata: Dict[str, str],
+) -> List[Output]:
+    outputs = []
+    for format, format_quality in qualities.items():
+        image_buffer = encode(image, format, format_quality)
+        output_bytes = image_buffer.seek(0, os.SEEK_END)
+        image_buffer.seek(0)
+
+        outputs.append(
+            Output(
+                jpeg_key if format == "jpeg" else variant_key(jpeg_key, format),
+                image_buffer,
+                output_bytes,
+                ENCODERS[format][0],
+                {
+                    **metadata,
+                    "quality": str(format_quality),
+                    "compression-ratio": f"{source_bytes / max(output_bytes, 1):.2f}",
+                },
+                image.width,
+                image.height,
+            )
+        )
+    return outputs
+
+
+def open_image(source: IO[bytes]) -> Image.Image:
+    image = Image.open(source, formats=INPUT_FORMATS)
+
+    # When every output is smaller than the source, let the JPEG decoder scale
+    # by 1/2, 1/4 or 1/8 in the DCT domain so the full bitmap is never built
+    if STREAMING and MAX_LONG_EDGE:
+        scale = max([MAX_LONG_EDGE, *RENDITION_SIZES]) / max(image.size)
+        if scale < 1:
+            image.draft(
+                "RGB",
+                (math.ceil(image.width * scale), math.ceil(image.height * scale)),
+            )
+
+    image.load()
+    return image
+
+
+def normalize(image: Image.Image) -> Image.Image:
+    """Convert to 8-bit L, RGB or, for images with transparency, RGBA. Returns
+    image itself when it already is one of those."""
+    if image.mode.startswith("I"):
+        # 16/32-bit greyscale: keep the high byte
+        return image.convert("I").point(lambda value: value * (1 / 256)).convert("L")
+
+    if image.mode in {"LA", "PA"} or (
+        image.mode == "P" and "transparency" in image.info
+    ):
+        return image.convert("RGBA")
+
+    if image.mode not in {"RGB", "RGBA", "L"}:
+        # CMYK, palette, bilevel, ...
+        return image.convert("RGB")
+
+    return image
+
+
+def flatten(image: Image.Image) -> Image.Image:
+    """Composite a normalized RGBA image onto white for formats without alpha.
+    Returns image itself when it has no alpha."""
+    if image.mode != "RGBA":
+        return image
+    flattened = Image.new("RGB", image.size, (255, 255, 255))
+    flattened.paste(image, mask=image.getchannel("A"))
+    return flattened
+
+
+def render(
+    image_orig: Image.Image, key: str, source_bytes: int, content_hash: str
+) -> List[Output]:
+    image_current = normalize(image_orig)
+    if MAX_LONG_EDGE:
+        image_current = quality.shrink(image_current, (MAX_LONG_EDGE, MAX_LONG_EDGE))
+
+    qualities = choose_qualities(image_current)
+    logger.info("%s: qualities %s", key, qualities)
+
+    # The source's hash lets a later dedup hit check that these outputs still
+    # belong to the content it was indexed for
+    metadata = {"content-hash": content_hash}
+    # Computed from the bitmap already decoded for the outputs
+    if PLACEHOLDER == "blurhash":
+        with timed("Placeholder"):
+            sample = quality.shrink(
+                image_current, (placeholder.SAMPLE_SIZE, placeholder.SAMPLE_SIZE)
+            )
+            metadata["blurhash"] = placeholder.blurhash(flatten(sample))
+
+    outputs = encode_all(image_current, key, qualities, source_bytes, metadata)
+
+    # Chain resizes from the largest rendition down so each step resamples the
+    # previous (already smaller) bitmap instead of the full-size original
+    for size in RENDITION_SIZES:
+        image_current = quality.shrink(image_current, (size, size))
+        outputs.extend(
+            encode_all(
+                image_current, rendition_key(key, size), qualities, source_bytes, metadata
+            )
+        )
+
+    return outputs
+
 
+def read_body(body: "StreamingBody") -> Tuple[IO[bytes], str]:
+    digest = hashlib.sha256()
+
+    if not STREAMING:
+        data = body.read()
+        digest.update(data)
+        return BytesIO(data), digest.hexdigest()
+
+    buffer = new_buffer()
+    for chunk in body.iter_chunks(chunk_size=STREAM_CHUNK_SIZE):
+        digest.update(chunk)
+        buffer.write(chunk)
+    buffer.seek(0)
+    return buffer, digest.hexdigest()
+
+
+def dedup_id(content_hash: str) -> str:
+    # Outputs only match if they were produced with the same settings:
+    # STREAMING decides whether JPEGs are decoded at a reduced scale, and
+    # copies keep the Cache-Control of the outputs they copy
+    settings = json.dumps(
+        [RENDITION_SIZES, MAX_LONG_EDGE, EXTRA_FORMATS, QUALITY_MODE, TARGET_SSIM]
+        + [MAX_BYTES, ENCODERS, PLACEHOLDER, MANIFEST, STREAMING, CACHE_CONTROL],
+        sort_keys=True,
+    )
+    return f"{content_hash}-{hashlib.sha256(settings.encode()).hexdigest()[:16]}"
+
+
+def copy_deduplicated(
+    s3_client: "S3Client", bucket: str, key: str, content_hash: str
+) -> Optional[Dict[str, Any]]:
+    """Copy the outputs indexed for content_hash to key and return the index
+    entry, or None when there is nothing (valid) to copy."""
+    item = dynamodb_client.get_item(
+        TableName=DEDUP_TABLE, Key={"hash": {"S": dedup_id(content_hash)}}
+    ).get("Item")
+    if item is None:
+        return None
+
+    source_bucket, source_key = item["bucket"]["S"], item["key"]["S"]
+    if (source_bucket, source_key) == (bucket, key):
+        # Re-upload to the same key: the original was overwritten, recompress
+        return None
+    if MANIFEST and "manifest" not in item:
+        # Indexed without its manifest, which the message is built from
+        return None
+
+    try:
+        for suffix in item["suffixes"]["L"]:
+            copy_source = {"Bucket": source_bucket, "Key": source_key + suffix["S"]}
+            # The indexed key may have been overwritten with other content since,
+            # so only outputs still stamped with this hash are copied, and the
+            # copy is pinned to the version checked. On a miss the upload is
+            # recompressed and the entry rewritten to point at it
+            head = s3_client.head_object(**copy_source)
+            if head["Metadata"].get("content-hash") != content_hash:
+                logger.info("%s: dedup entry %s is stale", key, copy_source["Key"])
+                return None
+            s3_client.copy_object(
+                Bucket=bucket,
+                Key=key + suffix["S"],
+                CopySource=copy_source,
+                CopySourceIfMatch=head["ETag"],
+                MetadataDirective="COPY",
+                TaggingDirective="COPY",
+            )
+    except ClientError as error:
+        # The earlier upload may have been deleted or replaced since the check
+        if error.response["Error"]["Code"] not in {
+            "NoSuchKey",
+            "404",
+            "PreconditionFailed",
+            "412",
+        }:
+            raise
+        return None
+
+    return item
+
+
+def index_outputs(
+    bucket: str,
+    key: str,
+    content_hash: str,
+    suffixes: List[str],
+    manifest: Optional[Dict[str, Any]],
+) -> None:
+    item = {
+        "hash": {"S": dedup_id(content_hash)},
+        "bucket": {"S": bucket},
+        "key": {"S": key},
+        "suffixes": {"L": [{"S": suffix} for suffix in suffixes]},
+        "expires_at": {"N": str(int(time.time()) + DEDUP_TTL_DAYS * 24 * 60 * 60)},
+    }
+    # Copies are announced from this rather than from their copied sidecar
+    if manifest is not None:
+        item["manifest"] = {"S": json.dumps(manifest, separators=(",", ":"))}
+    dynamodb_client.put_item(TableName=DEDUP_TABLE, Item=item)
+
+
+def build_manifest(
+    key: str,
+    source_format: str,
+    source_bytes: int,
+    content_hash: str,
+    outputs: List[Output],
+) -> Dict[str, Any]:
+    # outputs[0] is the full-size JPEG at the output key.
+    # Renditions are listed by key suffix so a deduplicated copy's manifest
+    # stays valid under its own key
+    image = outputs[0]
+    return {
+        "width": image.width,
+        "height": image.height,
+        "bytes": image.size,
+        "content_type": image.content_type,
+        "source": {"format": source_format, "bytes": source_bytes},
+        "content_hash": content_hash,
+        "placeholder": image.metadata.get("blurhash"),
+        "renditions": [
+            {
+                "suffix": output.key[len(key) :],
+                "width": output.width,
+                "height": output.height,
+                "bytes": output.size,
+                "content_type": output.content_type,
+            }
+            for output in outputs
+        ],
+    }
+
+
+def write_manifest(
+    s3_client: "S3Client", bucket: str, key: str, manifest: Dict[str, Any]
+) -> None:
     s3_client.put_object(
         Bucket=bucket,
-        Key=key,
-        Body=image_buffer,
-        ContentType="image/jpeg",
+        Key=key + MANIFEST_SUFFIX,
+        Body=json.dumps(manifest, separators=(",", ":")).encode(),
+        ContentType="application/json",
+        Metadata={**COMPRESSED_METADATA, "content-hash": manifest["content_hash"]},
         Tagging="compressed=true",
     )
 
-    image_buffer.close()
+
+def publish_manifest(bucket: str, key: str, manifest: Dict[str, Any]) -> None:
+    sqs_client.send_message(
+        QueueUrl=MANIFEST_QUEUE_URL,
+        MessageBody=json.dumps(
+            {"bucket": bucket, "key": key, **manifest}, separators=(",", ":")
+        ),
+    )
+
+
+def is_poison(error: Exception) -> bool:
+    """Whether an error raised while opening or decoding a source means the
+    file itself is bad."""
+    if isinstance(error, POISON_ERRORS):
+        return True
+    if isinstance(error, OSError):
+        return error.errno is None
+    return isinstance(error, DECODER_ERRORS)
+
+
+def route_large(bucket: str, key: str, reason: str) -> None:
+    # Same shape as an S3 notification so the worker parses it like one
+    sqs_client.send_message(
+        QueueUrl=LARGE_QUEUE_URL,
+        MessageBody=json.dumps(
+            {
+                "Records": [
+                    {"s3": {"bucket": {"name": bucket}, "object": {"key": quote_plus(key)}}}
+                ]
+            }
+        ),
+    )
+    logger.info("%s: routed to the worker (%s)", key, reason)
+    add_metric("Routed", MetricUnit.Count, 1)
+
+
+def quarantine(
+    s3_client: "S3Client", bucket: str, key: str, error: Exception
+) -> None:
+    logger.error("%s: quarantined", key, exc_info=error)
+    s3_client.put_object_tagging(
+        Bucket=bucket,
+        Key=key,
+        Tagging={
+            "TagSet": [{"Key": QUARANTINE_TAG, "Value": type(error).__name__}]
+        },
+    )
+    add_metric("Quarantined", MetricUnit.Count, 1)
+
+
+def upload(s3_client: "S3Client", bucket: str, output: Output) -> None:
+    if not STREAMING:
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=output.key,
+            Body=output.buffer,
+            ContentType=output.content_type,
+            CacheControl=CACHE_CONTROL,
+            Metadata={**output.metadata, **COMPRESSED_METADATA},
+            Tagging="compressed=true",
+        )
+        return
+
+    s3_client.upload_fileobj(
+        output.buffer,
+        bucket,
+        output.key,
+        ExtraArgs={
+            "ContentType": output.content_type,
+            "CacheControl": CACHE_CONTROL,
+            "Metadata": {**output.metadata, **COMPRESSED_METADATA},
+            "Tagging": "compressed=true",
+        },
+        Config=TRANSFER_CONFIG,
+    )
+
+
+def process_object(s3_client: "S3Client", bucket: str, key: str) -> None:
+    with timed("Get"):
+        object = s3_client.get_object(Bucket=bucket, Key=key)
+    if object["Metadata"].get("compressed") == "true":
+        # Our own output: drop the connection before any of the body is read
+        object["Body"].close()
+        add_metric("Skipped", MetricUnit.Count, 1)
+        return
+
+    if LARGE_QUEUE_URL and ROUTE_MAX_BYTES and object["ContentLength"] > ROUTE_MAX_BYTES:
+        object["Body"].close()
+        route_large(bucket, key, f"{object['ContentLength']} bytes")
+        return
+
+    with timed("Download"):
+        body, content_hash = read_body(object["Body"])
+
+    target = output_key(key)
+    if DEDUP_TABLE:
+        with timed("Dedup"):
+            deduplicated = copy_deduplicated(s3_client, bucket, target, content_hash)
+        if deduplicated is not None:
+            body.close()
+            if MANIFEST and MANIFEST_QUEUE_URL:
+                # Renditions are listed by suffix, so the indexed manifest
+                # describes the copies under this upload's output key as well
+                publish_manifest(bucket, key, json.loads(deduplicated["manifest"]["S"]))
+            add_metric("Deduplicated", MetricUnit.Count, 1)
+            return
+
+    with body:
+        # Only parsing and decoding the source can reveal a bad file; S3, SQS
+        # and encoding errors are retried like any other failure
+        pixels = 0
+        try:
+            if LARGE_QUEUE_URL and ROUTE_MAX_PIXELS:
+                # Image.open only parses the header; the bitmap is decoded by load()
+                with Image.open(body, formats=INPUT_FORMATS) as header:
+                    pixels = header.width * header.height
+                body.seek(0)
+            if not (ROUTE_MAX_PIXELS and pixels > ROUTE_MAX_PIXELS):
+                with timed("Decode"):
+                    image_orig = open_image(body)
+        except Exception as error:
+            if not is_poison(error):
+                raise
+            quarantine(s3_client, bucket, key, error)
+            return
+
+        if ROUTE_MAX_PIXELS and pixels > ROUTE_MAX_PIXELS:
+            route_large(bucket, key, f"{pixels} pixels")
+            return
+
+        with image_orig:
+            with timed("Encode"):
+                outputs = render(
+                    image_orig, target, object["ContentLength"], content_hash
+                )
+
+    with timed("Upload"):
+        for output in outputs:
+            upload(s3_client, bucket, output)
+
+            output.buffer.close()
+
+    suffixes = [output.key[len(target) :] for output in outputs]
+    manifest: Optional[Dict[str, Any]] = None
+    if MANIFEST:
+        manifest = build_manifest(
+            target, image_orig.format, object["ContentLength"], content_hash, outputs
+        )
+        with timed("Manifest"):
+            write_manifest(s3_client, bucket, target, manifest)
+            if MANIFEST_QUEUE_URL:
+                publish_manifest(bucket, key, manifest)
+        suffixes.append(MANIFEST_SUFFIX)
+
+    if DEDUP_TABLE:
+        index_outputs(bucket, target, content_hash, suffixes, manifest)
+
+    add_metric("Processed", MetricUnit.Count, 1)
+    add_metric("Pixels", MetricUnit.Count, image_orig.width * image_orig.height)
+    add_metric("InputBytes", MetricUnit.Bytes, object["ContentLength"])
+    add_metric("OutputBytes", MetricUnit.Bytes, sum(output.size for output in outputs))
+
+
+def process_message(s3_client: "S3Client", record: SQSRecord) -> None:
+    s3_event = S3Event(record.json_body)
+
+    # S3 posts an s3:TestEvent without records when the notification is created
+    if "Records" not in s3_event.raw_event:
+        return
+
+    for s3_record in s3_event.records:
+        process_object(
+            s3_client,
+            s3_record.s3.bucket.name,
+            unquote_plus(s3_record.s3.get_object.key),
+        )
+
+
+@metrics.log_metrics
+@event_source(data_class=SQSEvent)
+def handler(event: SQSEvent, _: LambdaContext) -> Dict[str, List[Dict[str, str]]]:
+    with timed("Batch"), ThreadPoolExecutor(max_workers=BATCH_WORKERS) as executor:
+        futures = {
+            record.message_id: executor.submit(process_message, s3_client, record)
+            for record in event.records
+        }
+
+    # Only the failed messages return to the queue; the rest of the batch is
+    # deleted even if one image is bad
+    batch_item_failures = []
+    for message_id, future in futures.items():
+        exception = future.exception()
+        if exception is not None:
+            logger.error(
+                "failed to process message %s", message_id, exc_info=exception
+            )
+            batch_item_failures.append({"itemIdentifier": message_id})
+
+    add_metric("Failed", MetricUnit.Count, len(batch_item_failures))
+    # ru_maxrss is reported in KiB on Linux
+    add_metric(
+        "PeakRss",
+        MetricUnit.Megabytes,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024,
+    )
+
+    return {"batchItemFailures": batch_item_failures}
@@ -0,0 +1,248 @@
+"""Offline benchmark for the compression handler.
+
+Runs app.handler against an in-process S3 stand-in over a seeded corpus of
+synthetic images and reports per-phase timings, images/sec and peak RSS as
+JSON so runs can be diffed across commits:
+
+    python benchmark.py --repeat 3 --output bench.json
+
+Handler settings are read from the same environment variables the Lambda
+uses (RENDITION_SIZES, STREAMING, EXTRA_FORMATS, ...).
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from io import BytesIO
+from typing import Any, Callable, Dict, List, Tuple
+
+from botocore.response import StreamingBody
+from PIL import Image, ImageDraw, ImageFilter
+
+# The handler's EMF metrics would interleave with the JSON report on stdout
+os.environ.setdefault("POWERTOOLS_METRICS_NAMESPACE", "benchmark")
+os.environ.setdefault("POWERTOOLS_METRICS_DISABLED", "true")
+# app creates its S3 client at import; it is replaced before any call
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-2")
+
+import app  # noqa: E402
+
+# (width, height, format) of every image in the corpus
+CORPUS_SPECS: List[Tuple[int, int, str]] = [
+    (640, 480, "jpeg"),
+    (1080, 1080, "png"),
+    (1920, 1080, "jpeg"),
+    (1920, 1080, "webp"),
+    (4032, 3024, "jpeg"),
+    (6000, 4000, "jpeg"),
+]
+
+PHASES = ["get", "download", "decode", "encode", "upload"]
+
+
+def make_image(width: int, height: int, seed: int) -> Image.Image:
+    # Shapes over a gradient, slightly blurred, so encoders see both flat
+    # regions and edges rather than noise or a solid fill
+    rng = random.Random(seed)
+    image = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    for _ in range(200):
+        x, y = rng.randrange(width), rng.randrange(height)
+        radius = rng.randrange(max(width, height) // 8 + 1)
+        draw.ellipse(
+            (x, y, x + radius, y + radius),
+            fill=tuple(rng.randrange(256) for _ in range(3)),
+        )
+    return image.filter(ImageFilter.GaussianBlur(1))
+
+
+def make_corpus() -> Dict[str, bytes]:
+    corpus = {}
+    for seed, (width, height, format) in enumerate(CORPUS_SPECS):
+        buffer = BytesIO()
+        make_image(width, height, seed).save(buffer, format=format, quality=90)
+        corpus[f"bench/{width}x{height}.{format}"] = buffer.getvalue()
+    return corpus
+
+
+class Timings:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.seconds: Dict[str, float] = defaultdict(float)
+
+    def add(self, phase: str, seconds: float) -> None:
+        with self.lock:
+            self.seconds[phase] += seconds
+
+    def wrap(self, phase: str, function: Callable[..., Any]) -> Callable[..., Any]:
+        def timed(*args: Any, **kwargs: Any) -> Any:
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(phase, time.perf_counter() - start)
+
+        return timed
+
+
+class FakeS3:
+    """Just enough of the S3 client for app.handler, backed by a dict."""
+
+    def __init__(self, objects: Dict[str, bytes], latency: float) -> None:
+        self.objects = {key: (body, {}) for key, body in objects.items()}
+        self.latency = latency
+        self.lock = threading.Lock()
+
+    def get_object(self, Bucket: str, Key: str) -> Dict[str, Any]:
+        time.sleep(self.latency)
+        body, metadata = self.objects[Key]
+        return {
+            "Body": StreamingBody(BytesIO(body), len(body)),
+            "ContentLength": len(body),
+            "Metadata": metadata,
+        }
+
+    def put_object(self, Bucket: str, Key: str, Body: Any, **kwargs: Any) -> None:
+        time.sleep(self.latency)
+        with self.lock:
+            data = Body if isinstance(Body, bytes) else Body.read()
+            self.objects[Key] = (data, kwargs.get("Metadata", {}))
+
+    def upload_fileobj(
+        self, Fileobj: Any, Bucket: str, Key: str, ExtraArgs: Any = None, **_: Any
+    ) -> None:
+        self.put_object(Bucket, Key, Fileobj, **(ExtraArgs or {}))
+
+
+def sqs_event(keys: List[str]) -> Dict[str, Any]:
+    return {
+        "Records": [
+            {
+                "messageId": str(index),
+                "body": json.dumps(
+                    {
+                        "Records": [
+                            {"s3": {"bucket": {"name": "bench"}, "object": {"key": key}}}
+                        ]
+                    }
+                ),
+            }
+            for index, key in enumerate(keys)
+        ]
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def cold_import_seconds() -> float:
+    # Import app in a fresh interpreter, as a Lambda cold start does
+    return float(
+        subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import time; start = time.perf_counter(); import app; "
+                "print(time.perf_counter() - start)",
+            ],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+    )
+
+
+def run(repeat: int, latency: float) -> Dict[str, Any]:
+    corpus = make_corpus()
+    timings = Timings()
+
+    s3_client = FakeS3(corpus, latency)
+    s3_client.get_object = timings.wrap("get", s3_client.get_object)
+    app.s3_client = s3_client
+    app.read_body = timings.wrap("download", app.read_body)
+    app.open_image = timings.wrap("decode", app.open_image)
+    app.render = timings.wrap("encode", app.render)
+    app.upload = timings.wrap("upload", app.upload)
+
+    images = 0
+    pass_seconds = []
+    for _ in range(repeat):
+        # Reset the originals so each pass recompresses rather than skipping
+        s3_client.objects.update({key: (body, {}) for key, body in corpus.items()})
+        start = time.perf_counter()
+        response = app.handler(sqs_event(list(corpus)), None)
+        pass_seconds.append(time.perf_counter() - start)
+        if response["batchItemFailures"]:
+            raise RuntimeError(f"handler failed: {response['batchItemFailures']}")
+        images += len(corpus)
+    elapsed = sum(pass_seconds)
+
+    return {
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "settings": {
+            name: os.environ[name]
+            for name in sorted(os.environ)
+            if name
+            in {
+                "RENDITION_SIZES",
+                "MAX_LONG_EDGE",
+                "STREAMING",
+                "EXTRA_FORMATS",
+                "QUALITY_MODE",
+                "BATCH_WORKERS",
+            }
+        },
+        "cold_import_seconds": round(cold_import_seconds(), 3),
+        "images": images,
+        "input_bytes": repeat * sum(len(body) for body in corpus.values()),
+        "seconds": round(elapsed, 3),
+        "images_per_second": round(images / elapsed, 2),
+        # The first pass pays for lazy initialisation; later passes are warm
+        "pass_seconds": [round(seconds, 3) for seconds in pass_seconds],
+        # Phases overlap across worker threads, so these are summed thread time
+        "phase_seconds": {
+            phase: round(timings.seconds[phase], 3) for phase in PHASES
+        },
+        # ru_maxrss is reported in KiB on Linux
+        "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--s3-latency-ms",
+        type=float,
+        default=0.0,
+        help="simulated round-trip time added to every S3 call",
+    )
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = json.dumps(run(args.repeat, args.s3_latency_ms / 1000), indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import math
+from typing import List
+
+import numpy as np
+from PIL import Image
+
+import quality
+
+# Basis functions per axis; 4x3 gives a ~28 character hash
+COMPONENTS_X = 4
+COMPONENTS_Y = 3
+# Long edge (px) the image is reduced to first; the hash only keeps the lowest
+# frequencies, so more pixels would not change it
+SAMPLE_SIZE = 32
+
+BASE83 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+
+
+def _base83(value: int, length: int) -> str:
+    return "".join(
+        BASE83[value // 83 ** (length - position) % 83]
+        for position in range(1, length + 1)
+    )
+
+
+def _linear_to_srgb(value: float) -> int:
+    value = min(max(value, 0.0), 1.0)
+    if value <= 0.0031308:
+        return int(value * 12.92 * 255 + 0.5)
+    return int((1.055 * value ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def _sign_pow(value: float, exponent: float) -> float:
+    return math.copysign(abs(value) ** exponent, value)
+
+
+def blurhash(image: Image.Image) -> str:
+    """BlurHash (https://blurha.sh) of image, for clients to paint while the
+    real image loads."""
+    sample = quality.shrink(image, (SAMPLE_SIZE, SAMPLE_SIZE)).convert("RGB")
+
+    srgb = np.asarray(sample, dtype=np.float64) / 255
+    linear = np.where(srgb <= 0.04045, srgb / 12.92, ((srgb + 0.055) / 1.055) ** 2.4)
+    height, width = linear.shape[:2]
+
+    basis_x = np.cos(np.pi * np.outer(np.arange(COMPONENTS_X), np.arange(width)) / width)
+    basis_y = np.cos(np.pi * np.outer(np.arange(COMPONENTS_Y), np.arange(height)) / height)
+    # factors[j, i] is the (i, j) component's mean colour, row by row
+    factors = np.einsum("jy,ix,yxc->jic", basis_y, basis_x, linear) / (width * height)
+    factors *= 2
+    factors[0, 0] /= 2
+    factors = factors.reshape(-1, 3)
+
+    dc, ac = factors[0], factors[1:]
+    parts: List[str] = [_base83(COMPONENTS_X - 1 + (COMPONENTS_Y - 1) * 9, 1)]
+
+    quantised_max = int(max(0, min(82, math.floor(np.abs(ac).max() * 166 - 0.5))))
+    maximum = (quantised_max + 1) / 166
+    parts.append(_base83(quantised_max, 1))
+
+    parts.append(
+        _base83(
+            (_linear_to_srgb(dc[0]) << 16)
+            + (_linear_to_srgb(dc[1]) << 8)
+            + _linear_to_srgb(dc[2]),
+            4,
+        )
+    )
+    for colour in ac:
+        quantised = [
+            int(max(0, min(18, math.floor(_sign_pow(value / maximum, 0.5) * 9 + 9.5))))
+            for value in colour
+        ]
+        parts.append(_base83(quantised[0] * 19 * 19 + quantised[1] * 19 + quantised[2], 2))
+
+    return "".join(parts)
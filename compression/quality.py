@@ -0,0 +1,106 @@
+import math
+from io import BytesIO
+from typing import Any, Callable, Dict, Tuple
+
+import numpy as np
+from PIL import Image
+
+# Long edge (px) of the proxy the quality search runs on
+PROXY_SIZE = 256
+QUALITY_MIN = 10
+QUALITY_MAX = 90
+
+BLOCK_SIZE = 8
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+
+
+def _round_aspect(number: float, key: Callable[[int], float]) -> int:
+    return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+
+def shrink(image: Image.Image, size: Tuple[int, int]) -> Image.Image:
+    """What image.thumbnail(size) would leave in image, as a new image and
+    without copying the full-size bitmap first; image itself if it fits."""
+    width, height = size
+    if width >= image.width and height >= image.height:
+        return image
+
+    aspect = image.width / image.height
+    if width / height >= aspect:
+        width = _round_aspect(height * aspect, lambda n: abs(aspect - n / height))
+    else:
+        height = _round_aspect(
+            width / aspect, lambda n: 0 if n == 0 else abs(aspect - width / n)
+        )
+    return image.resize((width, height), Image.Resampling.BICUBIC, reducing_gap=2.0)
+
+
+def make_proxy(image: Image.Image) -> Image.Image:
+    return shrink(image, (PROXY_SIZE, PROXY_SIZE))
+
+
+def _blocks(luma: np.ndarray) -> np.ndarray:
+    height = luma.shape[0] - luma.shape[0] % BLOCK_SIZE
+    width = luma.shape[1] - luma.shape[1] % BLOCK_SIZE
+    return (
+        luma[:height, :width]
+        .reshape(height // BLOCK_SIZE, BLOCK_SIZE, width // BLOCK_SIZE, BLOCK_SIZE)
+        .swapaxes(1, 2)
+        .reshape(-1, BLOCK_SIZE * BLOCK_SIZE)
+    )
+
+
+def ssim(reference: Image.Image, candidate: Image.Image) -> float:
+    # Mean SSIM over non-overlapping 8x8 luma blocks; coarser than the usual
+    # gaussian window but close enough to rank qualities against each other
+    x = _blocks(np.asarray(reference.convert("L"), dtype=np.float64))
+    y = _blocks(np.asarray(candidate.convert("L"), dtype=np.float64))
+    if x.size == 0:
+        return 1.0
+
+    mean_x, mean_y = x.mean(axis=1), y.mean(axis=1)
+    var_x, var_y = x.var(axis=1), y.var(axis=1)
+    cov_xy = ((x - mean_x[:, None]) * (y - mean_y[:, None])).mean(axis=1)
+
+    return float(
+        np.mean(
+            ((2 * mean_x * mean_y + SSIM_C1) * (2 * cov_xy + SSIM_C2))
+            / ((mean_x**2 + mean_y**2 + SSIM_C1) * (var_x + var_y + SSIM_C2))
+        )
+    )
+
+
+def choose_quality(
+    proxy: Image.Image,
+    format: str,
+    options: Dict[str, Any],
+    target_ssim: float = 0.0,
+    max_bits_per_pixel: float = 0.0,
+) -> int:
+    """Binary-search the lowest quality whose proxy encode reaches target_ssim,
+    or the highest quality that stays within max_bits_per_pixel."""
+    low, high = QUALITY_MIN, QUALITY_MAX
+    chosen = QUALITY_MAX if target_ssim else QUALITY_MIN
+
+    while low <= high:
+        quality = (low + high) // 2
+        buffer = BytesIO()
+        proxy.save(buffer, format=format, **{**options, "quality": quality})
+
+        if target_ssim:
+            buffer.seek(0)
+            # Only the format just written is tried, not every registered plugin
+            with Image.open(buffer, formats=[format.upper()]) as candidate:
+                if ssim(proxy, candidate) >= target_ssim:
+                    chosen, high = quality, quality - 1
+                else:
+                    low = quality + 1
+        else:
+            bits_per_pixel = buffer.tell() * 8 / (proxy.width * proxy.height)
+            if bits_per_pixel <= max_bits_per_pixel:
+                chosen, low = quality, quality + 1
+            else:
+                high = quality - 1
+
+    return chosen
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+from PIL import Image
+
+# app and worker read their settings and create their clients at import
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-2")
+os.environ.setdefault("POWERTOOLS_METRICS_NAMESPACE", "test")
+os.environ.setdefault("POWERTOOLS_METRICS_DISABLED", "true")
+os.environ.setdefault("WORKER_QUEUE_URL", "https://sqs.us-west-2.amazonaws.com/1/large")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fakes import FakeS3  # noqa: E402
+
+
+@pytest.fixture
+def gradient() -> Image.Image:
+    return Image.linear_gradient("L").resize((320, 240)).convert("RGB")
+
+
+@pytest.fixture
+def s3() -> FakeS3:
+    return FakeS3()
@@ -0,0 +1,101 @@
+import hashlib
+from io import BytesIO
+from typing import Any, Dict, List, Tuple
+
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+from PIL import Image
+
+
+def client_error(code: str, operation: str) -> ClientError:
+    return ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+
+class FakeS3:
+    """The S3 calls the compression code makes, backed by a dict of
+    key -> (body, metadata, tags)."""
+
+    def __init__(self) -> None:
+        self.objects: Dict[str, Tuple[bytes, Dict[str, str], Dict[str, str]]] = {}
+        self.copies: List[str] = []
+
+    def upload(self, key: str, body: bytes) -> None:
+        """Store key as a client upload would, without our metadata."""
+        self.objects[key] = (body, {}, {})
+
+    def body(self, key: str) -> bytes:
+        return self.objects[key][0]
+
+    def _object(self, key: str, operation: str):
+        if key not in self.objects:
+            raise client_error("NoSuchKey" if operation == "GetObject" else "404", operation)
+        return self.objects[key]
+
+    @staticmethod
+    def _etag(body: bytes) -> str:
+        return f'"{hashlib.md5(body).hexdigest()}"'
+
+    def get_object(self, Bucket: str, Key: str) -> Dict[str, Any]:
+        body, metadata, _ = self._object(Key, "GetObject")
+        return {
+            "Body": StreamingBody(BytesIO(body), len(body)),
+            "ContentLength": len(body),
+            "Metadata": dict(metadata),
+            "ETag": self._etag(body),
+        }
+
+    def head_object(self, Bucket: str, Key: str) -> Dict[str, Any]:
+        body, metadata, _ = self._object(Key, "HeadObject")
+        return {
+            "ContentLength": len(body),
+            "Metadata": dict(metadata),
+            "ETag": self._etag(body),
+        }
+
+    def put_object(self, Bucket: str, Key: str, Body: Any, **kwargs: Any) -> None:
+        data = Body if isinstance(Body, bytes) else Body.read()
+        tags = dict(
+            tag.split("=", 1) for tag in kwargs.get("Tagging", "").split("&") if tag
+        )
+        self.objects[Key] = (data, dict(kwargs.get("Metadata", {})), tags)
+
+    def upload_fileobj(
+        self, Fileobj: Any, Bucket: str, Key: str, ExtraArgs: Any = None, **_: Any
+    ) -> None:
+        self.put_object(Bucket, Key, Fileobj, **(ExtraArgs or {}))
+
+    def copy_object(
+        self,
+        Bucket: str,
+        Key: str,
+        CopySource: Dict[str, str],
+        CopySourceIfMatch: str = "",
+        **_: Any,
+    ) -> None:
+        body, metadata, tags = self._object(CopySource["Key"], "CopyObject")
+        if CopySourceIfMatch and CopySourceIfMatch != self._etag(body):
+            raise client_error("PreconditionFailed", "CopyObject")
+        self.objects[Key] = (body, dict(metadata), dict(tags))
+        self.copies.append(Key)
+
+    def put_object_tagging(self, Bucket: str, Key: str, Tagging: Dict[str, Any]) -> None:
+        body, metadata, tags = self._object(Key, "PutObjectTagging")
+        tags.update({tag["Key"]: tag["Value"] for tag in Tagging["TagSet"]})
+
+
+class FakeDynamoDB:
+    def __init__(self) -> None:
+        self.items: Dict[str, Dict[str, Any]] = {}
+
+    def get_item(self, TableName: str, Key: Dict[str, Any]) -> Dict[str, Any]:
+        item = self.items.get(Key["hash"]["S"])
+        return {"Item": item} if item is not None else {}
+
+    def put_item(self, TableName: str, Item: Dict[str, Any]) -> None:
+        self.items[Item["hash"]["S"]] = Item
+
+
+def image_bytes(color: Tuple[int, int, int], size=(64, 48), format="jpeg") -> bytes:
+    buffer = BytesIO()
+    Image.new("RGB", size, color).save(buffer, format=format)
+    return buffer.getvalue()
@@ -0,0 +1,150 @@
+import hashlib
+import json
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+import app
+from fakes import FakeDynamoDB, image_bytes
+
+RED = (220, 20, 20)
+BLUE = (20, 20, 220)
+
+
+@pytest.fixture(autouse=True)
+def dedup(monkeypatch):
+    table = FakeDynamoDB()
+    monkeypatch.setattr(app, "DEDUP_TABLE", "dedup")
+    monkeypatch.setattr(app, "dynamodb_client", table)
+    monkeypatch.setattr(app, "RENDITION_SIZES", [32])
+    monkeypatch.setattr(app, "MANIFEST", True)
+    return table
+
+
+def upload_and_process(s3, key, body):
+    s3.upload(key, body)
+    app.process_object(s3, "bucket", key)
+
+
+def color_of(s3, key):
+    with Image.open(BytesIO(s3.body(app.output_key(key)))) as image:
+        return image.convert("RGB").getpixel((0, 0))
+
+
+def outputs(key):
+    return [app.output_key(key + suffix) for suffix in ["", ".32.jpg", ".manifest.json"]]
+
+
+def assert_close(actual, expected):
+    assert all(abs(a - e) < 40 for a, e in zip(actual, expected)), (actual, expected)
+
+
+@pytest.mark.parametrize(
+    "name, value",
+    [
+        ("RENDITION_SIZES", [32, 16]),
+        ("STREAMING", not app.STREAMING),
+        ("CACHE_CONTROL", "public, max-age=60"),
+    ],
+)
+def test_dedup_id_depends_on_output_settings(monkeypatch, name, value):
+    before = app.dedup_id("abc")
+    assert before.startswith("abc-")
+    assert app.dedup_id("abc") == before
+
+    monkeypatch.setattr(app, name, value)
+    assert app.dedup_id("abc") != before
+
+
+def test_identical_upload_is_copied(s3):
+    upload_and_process(s3, "one.jpg", image_bytes(RED))
+    upload_and_process(s3, "two.jpg", image_bytes(RED))
+
+    assert s3.copies == outputs("two.jpg")
+    assert s3.body(app.output_key("two.jpg")) == s3.body(app.output_key("one.jpg"))
+
+
+def test_overwritten_source_is_not_copied(s3):
+    red = image_bytes(RED)
+    upload_and_process(s3, "one.jpg", red)
+    upload_and_process(s3, "one.jpg", image_bytes(BLUE))
+    upload_and_process(s3, "two.jpg", red)
+
+    assert s3.copies == []
+    assert_close(color_of(s3, "two.jpg"), RED)
+    assert_close(color_of(s3, "two.jpg.32.jpg"), RED)
+    manifest = json.loads(s3.body(app.output_key("two.jpg.manifest.json")))
+    assert manifest["content_hash"] == hashlib.sha256(red).hexdigest()
+
+    # The stale entry was rewritten to the key that now holds the content
+    upload_and_process(s3, "three.jpg", red)
+    assert s3.copies == outputs("three.jpg")
+    assert_close(color_of(s3, "three.jpg"), RED)
+
+
+def test_source_replaced_between_check_and_copy(s3, monkeypatch):
+    red = image_bytes(RED)
+    upload_and_process(s3, "one.jpg", red)
+
+    head_object = s3.head_object
+
+    def head_then_overwrite(Bucket, Key):
+        head = head_object(Bucket=Bucket, Key=Key)
+        s3.objects[Key] = (b"replaced", *s3.objects[Key][1:])
+        return head
+
+    monkeypatch.setattr(s3, "head_object", head_then_overwrite)
+    upload_and_process(s3, "two.jpg", red)
+
+    assert s3.copies == []
+    assert_close(color_of(s3, "two.jpg"), RED)
+
+
+class FakeSQS:
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, QueueUrl, MessageBody):
+        self.messages.append(json.loads(MessageBody))
+
+
+@pytest.fixture
+def manifest_queue(monkeypatch):
+    queue = FakeSQS()
+    monkeypatch.setattr(app, "MANIFEST_QUEUE_URL", "https://sqs/manifests")
+    monkeypatch.setattr(app, "sqs_client", queue)
+    return queue
+
+
+def test_copy_is_announced_from_the_index(s3, manifest_queue, monkeypatch):
+    red = image_bytes(RED)
+    upload_and_process(s3, "one.jpg", red)
+
+    get_object = s3.get_object
+
+    def get_object_except_sidecars(Bucket, Key):
+        assert not Key.endswith(app.MANIFEST_SUFFIX)
+        return get_object(Bucket=Bucket, Key=Key)
+
+    monkeypatch.setattr(s3, "get_object", get_object_except_sidecars)
+    upload_and_process(s3, "two.jpg", red)
+
+    first, second = manifest_queue.messages
+    assert (second["bucket"], second["key"]) == ("bucket", "two.jpg")
+    assert {**second, "key": "one.jpg"} == first
+
+
+def test_entry_without_manifest_is_recompressed(s3, dedup, manifest_queue):
+    red = image_bytes(RED)
+    upload_and_process(s3, "one.jpg", red)
+    for item in dedup.items.values():
+        del item["manifest"]
+
+    upload_and_process(s3, "two.jpg", red)
+
+    assert s3.copies == []
+    assert [message["key"] for message in manifest_queue.messages] == ["one.jpg", "two.jpg"]
+    # The entry was rewritten with its manifest, so the next copy works again
+    upload_and_process(s3, "three.jpg", red)
+    assert s3.copies == outputs("three.jpg")
@@ -0,0 +1,40 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+import app
+
+
+@pytest.fixture
+def transparent_png():
+    image = Image.new("RGBA", (64, 48), (220, 20, 20, 255))
+    image.paste((0, 0, 0, 0), (0, 0, 32, 48))
+    buffer = BytesIO()
+    image.save(buffer, format="png")
+    return buffer.getvalue()
+
+
+def decoded(s3, key):
+    with Image.open(BytesIO(s3.body(key))) as image:
+        image.load()
+        return image
+
+
+@pytest.mark.parametrize("format", ["webp", "avif"])
+def test_transparent_png_keeps_alpha_in_variants(s3, monkeypatch, transparent_png, format):
+    monkeypatch.setattr(app, "EXTRA_FORMATS", [format])
+    monkeypatch.setattr(app, "RENDITION_SIZES", [32])
+    s3.upload("logo.png", transparent_png)
+
+    app.process_object(s3, "bucket", "logo.png")
+
+    for key in [f"logo.png.{format}", f"logo.png.32.jpg.{format}"]:
+        variant = decoded(s3, app.output_key(key))
+        assert variant.mode == "RGBA"
+        assert variant.getchannel("A").getextrema()[0] < 16
+
+    # JPEG has no alpha: the transparent half is white
+    jpeg = decoded(s3, app.output_key("logo.png"))
+    assert jpeg.mode == "RGB"
+    assert min(jpeg.getpixel((4, 24))) > 235
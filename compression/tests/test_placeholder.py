@@ -0,0 +1,16 @@
+from PIL import Image
+
+import placeholder
+
+
+# Expected hashes are the reference encoder's (blurhash 1.1.5) for the same
+# 32px sample
+def test_blurhash_matches_reference_for_solid_image():
+    assert (
+        placeholder.blurhash(Image.new("RGB", (64, 48), (255, 0, 0)))
+        == "LDTI:j]9fQ]9|co1fQo1fQfQfQfQ"
+    )
+
+
+def test_blurhash_matches_reference_for_gradient(gradient):
+    assert placeholder.blurhash(gradient) == "LyHV9woffQof00WBfQWBxuj[fQj["
@@ -0,0 +1,116 @@
+import errno
+
+import pytest
+from PIL import Image
+
+import app
+from fakes import client_error, image_bytes
+
+RED = (220, 20, 20)
+
+
+def quarantine_tag(s3, key):
+    return s3.objects[key][2].get(app.QUARANTINE_TAG)
+
+
+def test_unidentified_file_is_quarantined(s3):
+    s3.upload("notes.jpg", b"not an image at all")
+
+    app.process_object(s3, "bucket", "notes.jpg")
+
+    assert quarantine_tag(s3, "notes.jpg") == "UnidentifiedImageError"
+    assert list(s3.objects) == ["notes.jpg"]
+
+
+def test_truncated_file_is_quarantined(s3):
+    s3.upload("cut.png", image_bytes(RED, size=(256, 256), format="png")[:200])
+
+    app.process_object(s3, "bucket", "cut.png")
+
+    assert quarantine_tag(s3, "cut.png") is not None
+
+
+def test_decompression_bomb_is_quarantined(s3, monkeypatch):
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 100)
+    s3.upload("bomb.jpg", image_bytes(RED))
+
+    app.process_object(s3, "bucket", "bomb.jpg")
+
+    assert quarantine_tag(s3, "bomb.jpg") in {
+        "DecompressionBombError",
+        "DecompressionBombWarning",
+    }
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        OSError(errno.ENOSPC, "No space left on device"),
+        client_error("SlowDown", "GetObject"),
+    ],
+)
+def test_system_errors_while_decoding_are_retried(s3, monkeypatch, error):
+    def open_image(source):
+        raise error
+
+    monkeypatch.setattr(app, "open_image", open_image)
+    s3.upload("photo.jpg", image_bytes(RED))
+
+    with pytest.raises(type(error)):
+        app.process_object(s3, "bucket", "photo.jpg")
+    assert quarantine_tag(s3, "photo.jpg") is None
+
+
+def test_errors_after_decoding_are_retried(s3, monkeypatch):
+    def render(*args):
+        raise ValueError("bug in an encoder")
+
+    monkeypatch.setattr(app, "render", render)
+    s3.upload("photo.jpg", image_bytes(RED))
+
+    with pytest.raises(ValueError):
+        app.process_object(s3, "bucket", "photo.jpg")
+    assert quarantine_tag(s3, "photo.jpg") is None
+
+
+def test_routing_failure_is_retried(s3, monkeypatch):
+    class FailingSQS:
+        def send_message(self, **_):
+            raise client_error("ServiceUnavailable", "SendMessage")
+
+    monkeypatch.setattr(app, "LARGE_QUEUE_URL", "https://sqs/large")
+    monkeypatch.setattr(app, "ROUTE_MAX_PIXELS", 100)
+    monkeypatch.setattr(app, "sqs_client", FailingSQS())
+    s3.upload("large.jpg", image_bytes(RED))
+
+    with pytest.raises(Exception, match="ServiceUnavailable"):
+        app.process_object(s3, "bucket", "large.jpg")
+    assert quarantine_tag(s3, "large.jpg") is None
+
+
+@pytest.mark.parametrize("mode", ["RGBA", "LA", "PA"])
+def test_normalize_keeps_transparency(mode):
+    assert app.normalize(Image.new(mode, (4, 4))).mode == "RGBA"
+
+
+def test_flatten_composites_onto_white():
+    image = Image.new("RGBA", (4, 4), (0, 0, 0, 0))
+
+    flattened = app.flatten(image)
+
+    assert flattened.mode == "RGB"
+    assert flattened.getpixel((0, 0)) == (255, 255, 255)
+
+
+@pytest.mark.parametrize(
+    "mode, expected",
+    [("I;16", "L"), ("CMYK", "RGB"), ("P", "RGB"), ("1", "RGB")],
+)
+def test_normalize_converts_to_8_bit(mode, expected):
+    assert app.normalize(Image.new(mode, (4, 4))).mode == expected
+
+
+@pytest.mark.parametrize("mode", ["RGB", "RGBA", "L"])
+def test_normalize_keeps_8_bit_images(mode):
+    image = Image.new(mode, (4, 4))
+    assert app.normalize(image) is image
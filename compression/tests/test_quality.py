@@ -0,0 +1,67 @@
+from io import BytesIO
+
+from PIL import Image
+
+import quality
+
+
+def encoded_bits_per_pixel(image, format_quality):
+    buffer = BytesIO()
+    image.save(buffer, format="jpeg", quality=format_quality)
+    return buffer.tell() * 8 / (image.width * image.height)
+
+
+def test_ssim_of_identical_images_is_one(gradient):
+    assert quality.ssim(gradient, gradient) == 1.0
+
+
+def test_choose_quality_reaches_target_ssim(gradient):
+    chosen = quality.choose_quality(gradient, "jpeg", {}, target_ssim=0.9)
+
+    assert quality.QUALITY_MIN <= chosen <= quality.QUALITY_MAX
+    buffer = BytesIO()
+    gradient.save(buffer, format="jpeg", quality=chosen)
+    buffer.seek(0)
+    with Image.open(buffer) as candidate:
+        assert quality.ssim(gradient, candidate) >= 0.9
+
+
+def test_choose_quality_opens_candidates_as_the_encoded_format(gradient, monkeypatch):
+    opened = []
+    image_open = Image.open
+
+    def open_and_record(buffer, *args, **kwargs):
+        opened.append(kwargs.get("formats"))
+        return image_open(buffer, *args, **kwargs)
+
+    monkeypatch.setattr(Image, "open", open_and_record)
+    quality.choose_quality(gradient, "webp", {}, target_ssim=0.9)
+
+    assert opened and all(formats == ["WEBP"] for formats in opened)
+
+
+def test_choose_quality_fits_byte_budget(gradient):
+    budget = encoded_bits_per_pixel(gradient, 50)
+
+    chosen = quality.choose_quality(gradient, "jpeg", {}, max_bits_per_pixel=budget)
+
+    assert chosen >= 50
+    assert encoded_bits_per_pixel(gradient, chosen) <= budget
+
+
+def test_choose_quality_falls_to_minimum_when_nothing_fits(gradient):
+    assert (
+        quality.choose_quality(gradient, "jpeg", {}, max_bits_per_pixel=1e-6)
+        == quality.QUALITY_MIN
+    )
+
+
+def test_shrink_matches_thumbnail(gradient):
+    for size in [(160, 160), (97, 1000), (1000, 31), (10_000, 10_000)]:
+        expected = gradient.copy()
+        expected.thumbnail(size)
+
+        shrunk = quality.shrink(gradient, size)
+
+        assert shrunk.size == expected.size
+        assert shrunk.tobytes() == expected.tobytes()
@@ -0,0 +1,131 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+import app
+import transform
+from fakes import image_bytes
+
+RED = (220, 20, 20)
+
+
+@pytest.fixture(autouse=True)
+def allowed(monkeypatch, s3):
+    monkeypatch.setattr(transform, "WIDTHS", {32, 64})
+    monkeypatch.setattr(transform, "QUALITIES", {50, 85})
+    monkeypatch.setattr(transform, "BUCKETS", {"public", "private"})
+    monkeypatch.setattr(app, "s3_client", s3)
+
+
+def request(path, headers):
+    event = {"rawPath": path, "headers": headers, "requestContext": {}}
+    return transform.handler(event, None)
+
+
+@pytest.mark.parametrize(
+    "path, expected",
+    [
+        ("/t/32/jpeg/50/a/b.jpg", transform.Variant(32, "jpeg", 50, "a/b.jpg")),
+        ("/t/64/jpeg/85/with%20space.jpg", transform.Variant(64, "jpeg", 85, "with space.jpg")),
+        ("/x/32/jpeg/50/a.jpg", None),
+        ("/t/48/jpeg/50/a.jpg", None),  # width not offered
+        ("/t/32/jpeg/60/a.jpg", None),  # quality not offered
+        ("/t/32/gif/50/a.jpg", None),
+        ("/t/32/jpeg/-50/a.jpg", None),
+        ("/t/32/jpeg/50/", None),
+        ("/t/32/jpeg/50", None),
+    ],
+)
+def test_parse_path(path, expected):
+    assert transform.parse_path(path) == expected
+
+
+def test_missing_bucket_header_is_rejected(s3):
+    assert request("/t/32/jpeg/50/a.jpg", {})["statusCode"] == 400
+
+
+def test_unlisted_bucket_is_forbidden(s3):
+    s3.upload("a.jpg", image_bytes(RED))
+
+    response = request("/t/32/jpeg/50/a.jpg", {"x-image-bucket": "someone-elses"})
+
+    assert response["statusCode"] == 403
+    assert list(s3.objects) == ["a.jpg"]
+
+
+def test_variant_is_rendered_and_kept(s3):
+    s3.upload("a.jpg", image_bytes(RED))
+
+    response = request("/t/32/jpeg/50/a.jpg", {"x-image-bucket": "public"})
+
+    assert response["statusCode"] == 200
+    with Image.open(BytesIO(s3.body("_variants/32/jpeg/50/a.jpg"))) as variant:
+        assert variant.width == 32
+
+
+def test_missing_source_is_not_found(s3):
+    assert request("/t/32/jpeg/50/a.jpg", {"x-image-bucket": "public"})["statusCode"] == 404
+
+
+def test_invalid_transform_path_is_rejected():
+    assert request("/t/48/jpeg/50/a.jpg", {"x-image-bucket": "public"})["statusCode"] == 400
+
+
+def test_variant_is_resized_from_the_untouched_upload(s3, monkeypatch):
+    monkeypatch.setattr(app, "RENDITION_SIZES", [])
+    monkeypatch.setattr(app, "MAX_LONG_EDGE", 32)
+    upload = image_bytes(RED, size=(128, 96))
+    s3.upload("a.jpg", upload)
+    app.process_object(s3, "public", "a.jpg")
+
+    response = request("/t/64/jpeg/85/a.jpg", {"x-image-bucket": "public"})
+
+    assert s3.body("a.jpg") == upload
+    assert response["statusCode"] == 200
+    with Image.open(BytesIO(s3.body("_variants/64/jpeg/85/a.jpg"))) as variant:
+        assert variant.width == 64
+
+
+def test_source_over_byte_limit_is_refused(s3, monkeypatch):
+    monkeypatch.setattr(transform, "MAX_BYTES", 100)
+    s3.upload("a.jpg", image_bytes(RED))
+
+    assert request("/t/32/jpeg/50/a.jpg", {"x-image-bucket": "public"})["statusCode"] == 422
+    assert list(s3.objects) == ["a.jpg"]
+
+
+def test_source_over_pixel_limit_is_refused(s3, monkeypatch):
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+    s3.upload("a.jpg", image_bytes(RED))
+
+    assert request("/t/32/jpeg/50/a.jpg", {"x-image-bucket": "public"})["statusCode"] == 422
+    assert list(s3.objects) == ["a.jpg"]
+
+
+@pytest.mark.parametrize(
+    "path, location",
+    [
+        ("/_compressed/photos/a.jpg", "/t/64/jpeg/85/photos/a.jpg"),
+        ("/_compressed/photos/a.jpg.webp", "/t/64/webp/85/photos/a.jpg"),
+        ("/_compressed/with%20space.jpg.webp", "/t/64/webp/85/with%20space.jpg"),
+    ],
+)
+def test_missing_output_redirects_to_a_variant(monkeypatch, path, location):
+    monkeypatch.setattr(app, "EXTRA_FORMATS", ["webp"])
+    monkeypatch.setattr(app, "OUTPUT_PREFIX", "_compressed")
+
+    response = request(path, {"x-image-bucket": "public"})
+
+    assert response["statusCode"] == 302
+    assert response["headers"]["Location"] == location
+    assert response["headers"]["Cache-Control"] == transform.ERROR_CACHE_CONTROL
+
+
+def test_path_outside_the_outputs_is_not_found(monkeypatch):
+    monkeypatch.setattr(app, "EXTRA_FORMATS", ["webp"])
+    monkeypatch.setattr(app, "OUTPUT_PREFIX", "_compressed")
+
+    assert request("/photos/a.jpg", {"x-image-bucket": "public"})["statusCode"] == 404
+    assert request("/_compressed/", {"x-image-bucket": "public"})["statusCode"] == 404
+    assert request("/_compressed/.webp", {"x-image-bucket": "public"})["statusCode"] == 404
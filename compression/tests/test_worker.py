@@ -0,0 +1,61 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import app
+import worker
+
+
+class FakeSQS:
+    def __init__(self):
+        self.extended = []
+        self.deleted = []
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        self.extended.append(sorted(entry["ReceiptHandle"] for entry in Entries))
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries]}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.deleted.extend(entry["ReceiptHandle"] for entry in Entries)
+
+
+class FakeCloudWatch:
+    def put_metric_data(self, Namespace, MetricData):
+        pass
+
+
+@pytest.fixture
+def sqs(monkeypatch):
+    sqs = FakeSQS()
+    monkeypatch.setattr(worker, "sqs_client", sqs)
+    monkeypatch.setattr(worker, "cloudwatch_client", FakeCloudWatch())
+    monkeypatch.setattr(worker, "HEARTBEAT_SECONDS", 0.01)
+    return sqs
+
+
+def message(name):
+    return {"MessageId": name, "ReceiptHandle": name, "Body": name}
+
+
+def test_visibility_is_extended_while_processing(sqs, monkeypatch):
+    slow_done = threading.Event()
+
+    def process_message(s3_client, record):
+        if record.message_id == "slow":
+            # Finish only after a heartbeat covered this message
+            while not sqs.extended:
+                threading.Event().wait(0.01)
+            slow_done.set()
+        elif record.message_id == "bad":
+            raise RuntimeError("boom")
+
+    monkeypatch.setattr(app, "process_message", process_message)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        worker.process_batch(
+            executor, [message("fast"), message("slow"), message("bad")]
+        )
+
+    assert slow_done.is_set()
+    assert sqs.extended and all("slow" in handles for handles in sqs.extended)
+    assert sorted(sqs.deleted) == ["fast", "slow"]
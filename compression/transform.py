@@ -0,0 +1,227 @@
+"""On-demand resizing origin for the image CDNs.
+
+CloudFront forwards /<prefix>/<width>/<format>/<quality>/<key> to this
+function's URL, signed through an origin access control and with the bucket
+named in the x-image-bucket origin header; only buckets listed in
+IMAGE_BUCKETS are served. Variants are resized from the upload at <key>, which
+the compression function leaves untouched, and written under VARIANT_PREFIX in
+that bucket the first time they are requested, so a CDN miss for a popular
+image reads one object instead of decoding the source again.
+
+The function is also the image CDNs' failover origin: an output the bucket
+does not hold (yet) under app.OUTPUT_PREFIX is redirected to the largest
+variant of its upload.
+"""
+import base64
+import math
+import os
+from tempfile import SpooledTemporaryFile
+from typing import IO, TYPE_CHECKING, Any, Dict, NamedTuple, Optional
+from urllib.parse import unquote
+
+from aws_lambda_powertools.metrics import MetricUnit
+from aws_lambda_powertools.utilities.data_classes import (
+    LambdaFunctionUrlEvent,
+    event_source,
+)
+from aws_lambda_powertools.utilities.typing import LambdaContext
+from botocore.exceptions import ClientError
+from PIL import Image
+
+import app
+import quality
+
+if TYPE_CHECKING:
+    from botocore.response import StreamingBody
+
+# Widths and qualities that may be requested; anything else is rejected so the
+# variant cache cannot be filled with arbitrary combinations
+WIDTHS = {
+    int(width) for width in os.environ.get("TRANSFORM_WIDTHS", "").split(",") if width
+}
+QUALITIES = {
+    int(format_quality)
+    for format_quality in os.environ.get("TRANSFORM_QUALITIES", "").split(",")
+    if format_quality
+}
+BUCKETS = {bucket for bucket in os.environ.get("IMAGE_BUCKETS", "").split(",") if bucket}
+FORMATS = {"jpeg", *app.EXTRA_FORMATS}
+PATH_PREFIX = os.environ.get("TRANSFORM_PATH_PREFIX", "t")
+VARIANT_PREFIX = os.environ.get("VARIANT_PREFIX", "_variants")
+# Sources over MAX_BYTES are refused before they are read, and sources over
+# MAX_PIXELS (app.MAX_PIXELS, from the header) before they are decoded, so a
+# request never needs more memory or time than the function is sized for
+MAX_BYTES = int(os.environ.get("TRANSFORM_MAX_BYTES", "0"))
+# Errors are cached briefly so a bad URL cannot be used to bypass the CDN
+ERROR_CACHE_CONTROL = "public, max-age=60"
+
+
+class Variant(NamedTuple):
+    width: int
+    format: str
+    quality: int
+    key: str
+
+
+def parse_path(path: str) -> Optional[Variant]:
+    parts = path.lstrip("/").split("/", 4)
+    if len(parts) != 5:
+        return None
+
+    prefix, width, format, format_quality, key = parts
+    if prefix != PATH_PREFIX:
+        return None
+    if not (width.isdigit() and format_quality.isdigit() and key):
+        return None
+    if int(width) not in WIDTHS or format not in FORMATS:
+        return None
+    if int(format_quality) not in QUALITIES:
+        return None
+
+    return Variant(int(width), format, int(format_quality), unquote(key))
+
+
+def fallback_location(path: str) -> Optional[str]:
+    # /<output prefix>/<key>[.<format>] -> the largest variant of <key>, at the
+    # best quality offered, in the format the viewer negotiated
+    prefix = f"/{app.OUTPUT_PREFIX}/"
+    if not (path.startswith(prefix) and WIDTHS and QUALITIES):
+        return None
+
+    key, format = path[len(prefix) :], "jpeg"
+    for extra_format in app.EXTRA_FORMATS:
+        if key.endswith(f".{extra_format}"):
+            key, format = key[: -len(extra_format) - 1], extra_format
+            break
+    if not key:
+        return None
+    return f"/{PATH_PREFIX}/{max(WIDTHS)}/{format}/{max(QUALITIES)}/{key}"
+
+
+def response(
+    status: int,
+    body: bytes = b"",
+    content_type: str = "text/plain",
+    headers: Optional[Dict[str, str]] = None,
+) -> Dict[str, Any]:
+    return {
+        "statusCode": status,
+        "headers": {
+            "Content-Type": content_type,
+            "Cache-Control": app.CACHE_CONTROL if status == 200 else ERROR_CACHE_CONTROL,
+            **(headers or {}),
+        },
+        "body": base64.b64encode(body).decode(),
+        "isBase64Encoded": True,
+    }
+
+
+def get_object(bucket: str, key: str) -> Optional[Dict[str, Any]]:
+    try:
+        return app.s3_client.get_object(Bucket=bucket, Key=key)
+    except ClientError as error:
+        if error.response["Error"]["Code"] in {"NoSuchKey", "404"}:
+            return None
+        raise
+
+
+def spool(body: "StreamingBody") -> IO[bytes]:
+    # As app.read_body in streaming mode: only SPOOL_MAX_SIZE stays in memory
+    buffer = SpooledTemporaryFile(max_size=app.SPOOL_MAX_SIZE)
+    for chunk in body.iter_chunks(chunk_size=app.STREAM_CHUNK_SIZE):
+        buffer.write(chunk)
+    buffer.seek(0)
+    return buffer
+
+
+def transform(source: IO[bytes], variant: Variant) -> IO[bytes]:
+    with Image.open(source, formats=app.INPUT_FORMATS) as image:
+        # As in app.open_image, let JPEG sources decode at a reduced DCT scale
+        scale = variant.width / image.width
+        if scale < 1:
+            image.draft(
+                "RGB",
+                (math.ceil(image.width * scale), math.ceil(image.height * scale)),
+            )
+        image.load()
+
+        resized = app.normalize(image)
+        # Never upscale: a width above the source's is served at source size
+        resized = quality.shrink(resized, (variant.width, resized.height))
+        return app.encode(resized, variant.format, variant.quality)
+
+
+@app.metrics.log_metrics
+@event_source(data_class=LambdaFunctionUrlEvent)
+def handler(event: LambdaFunctionUrlEvent, _: LambdaContext) -> Dict[str, Any]:
+    bucket = event.headers.get("x-image-bucket")
+    if bucket is None:
+        return response(400)
+    if bucket not in BUCKETS:
+        return response(403)
+
+    if not event.raw_path.startswith(f"/{PATH_PREFIX}/"):
+        # Failover from the bucket: the output has not been written yet (or
+        # the upload was quarantined), so send the viewer to a variant resized
+        # from the upload. Cached as briefly as any error, so the output is used
+        # once it exists
+        location = fallback_location(event.raw_path)
+        if location is None:
+            return response(404)
+        return response(302, headers={"Location": location})
+
+    variant = parse_path(event.raw_path)
+    if variant is None:
+        return response(400)
+
+    variant_key = (
+        f"{VARIANT_PREFIX}/{variant.width}/{variant.format}/{variant.quality}/{variant.key}"
+    )
+    content_type = app.ENCODERS[variant.format][0]
+
+    with app.timed("VariantGet"):
+        cached = get_object(bucket, variant_key)
+    if cached is not None:
+        app.add_metric("VariantHit", MetricUnit.Count, 1)
+        return response(200, cached["Body"].read(), content_type)
+
+    with app.timed("Get"):
+        source = get_object(bucket, variant.key)
+    if source is None:
+        return response(404)
+    if MAX_BYTES and source["ContentLength"] > MAX_BYTES:
+        source["Body"].close()
+        app.logger.warning(
+            "%s: %d bytes is over the limit", variant.key, source["ContentLength"]
+        )
+        return response(422)
+
+    with app.timed("Download"):
+        body = spool(source["Body"])
+
+    with body:
+        try:
+            with app.timed("Transform"):
+                output = transform(body, variant)
+        except Exception as error:
+            if not app.is_poison(error):
+                raise
+            app.logger.exception("%s: cannot transform", variant.key)
+            return response(422)
+
+    with output:
+        body = output.read()
+    with app.timed("Upload"):
+        app.s3_client.put_object(
+            Bucket=bucket,
+            Key=variant_key,
+            Body=body,
+            ContentType=content_type,
+            CacheControl=app.CACHE_CONTROL,
+            Metadata=app.COMPRESSED_METADATA,
+            Tagging="compressed=true",
+        )
+
+    app.add_metric("VariantMiss", MetricUnit.Count, 1)
+    app.add_metric("OutputBytes", MetricUnit.Bytes, len(body))
+    return response(200, body, content_type)
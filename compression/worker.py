@@ -0,0 +1,160 @@
+"""Long-running SQS consumer for images the Lambda routes away.
+
+Runs the same process_message as app.handler, on a Fargate task with the
+memory and time that very large images need. Messages are deleted only once
+processed; while they are, their visibility is extended so a long job is not
+handed to another task. Failures return to the queue after its visibility
+timeout.
+Metrics are buffered per batch like an invocation and sent with
+PutMetricData, since only Lambda extracts EMF from stdout on its own.
+"""
+import logging
+import os
+import resource
+import signal
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Dict, List
+
+from aws_lambda_powertools.metrics import MetricUnit
+from aws_lambda_powertools.utilities.data_classes.sqs_event import SQSRecord
+import boto3
+from botocore.config import Config
+
+import app
+
+logger = logging.getLogger()
+
+QUEUE_URL = os.environ["WORKER_QUEUE_URL"]
+BATCH_SIZE = int(os.environ.get("WORKER_BATCH_SIZE", "1"))
+VISIBILITY_TIMEOUT = int(os.environ.get("WORKER_VISIBILITY_TIMEOUT_SECONDS", "900"))
+# Messages still being processed are extended this often, well before they
+# would become visible again
+HEARTBEAT_SECONDS = VISIBILITY_TIMEOUT / 3
+# CloudWatch accepts at most this many values per metric datum
+MAX_METRIC_VALUES = 150
+
+sqs_client = boto3.client("sqs", config=Config(tcp_keepalive=True))
+cloudwatch_client = boto3.client("cloudwatch")
+
+running = True
+
+
+def stop(*_: Any) -> None:
+    # ECS sends SIGTERM before stopping the task; finish the current batch
+    global running
+    running = False
+
+
+def publish_metrics() -> None:
+    with app.metrics_lock:
+        if not app.metrics.metric_set:
+            return
+        metric_set = app.metrics.serialize_metric_set()
+        app.metrics.clear_metrics()
+
+    directive = metric_set["_aws"]["CloudWatchMetrics"][0]
+    dimensions = [
+        {"Name": name, "Value": metric_set[name]} for name in directive["Dimensions"][0]
+    ]
+    metric_data: List[Dict[str, Any]] = []
+    for metric in directive["Metrics"]:
+        values = metric_set[metric["Name"]]
+        values = values if isinstance(values, list) else [values]
+        for start in range(0, len(values), MAX_METRIC_VALUES):
+            metric_data.append(
+                {
+                    "MetricName": metric["Name"],
+                    "Unit": metric["Unit"],
+                    "Dimensions": dimensions,
+                    "Values": values[start : start + MAX_METRIC_VALUES],
+                }
+            )
+
+    for start in range(0, len(metric_data), 1000):
+        cloudwatch_client.put_metric_data(
+            Namespace=directive["Namespace"], MetricData=metric_data[start : start + 1000]
+        )
+
+
+def extend_visibility(receipt_handles: List[str]) -> None:
+    failed = sqs_client.change_message_visibility_batch(
+        QueueUrl=QUEUE_URL,
+        Entries=[
+            {
+                "Id": str(index),
+                "ReceiptHandle": receipt_handle,
+                "VisibilityTimeout": VISIBILITY_TIMEOUT,
+            }
+            for index, receipt_handle in enumerate(receipt_handles)
+        ],
+    ).get("Failed", [])
+    for entry in failed:
+        logger.warning("failed to extend message visibility: %s", entry["Message"])
+
+
+def process_batch(executor: ThreadPoolExecutor, messages: List[Dict[str, Any]]) -> None:
+    with app.timed("Batch"):
+        futures = {
+            message["ReceiptHandle"]: executor.submit(
+                app.process_message,
+                app.s3_client,
+                SQSRecord({"messageId": message["MessageId"], "body": message["Body"]}),
+            )
+            for message in messages
+        }
+        pending = set(futures.values())
+        while pending:
+            _, pending = wait(pending, timeout=HEARTBEAT_SECONDS)
+            if pending:
+                extend_visibility(
+                    [
+                        receipt_handle
+                        for receipt_handle, future in futures.items()
+                        if future in pending
+                    ]
+                )
+
+    processed = []
+    for receipt_handle, future in futures.items():
+        exception = future.exception()
+        if exception is not None:
+            logger.error("failed to process message", exc_info=exception)
+        else:
+            processed.append(receipt_handle)
+
+    if processed:
+        sqs_client.delete_message_batch(
+            QueueUrl=QUEUE_URL,
+            Entries=[
+                {"Id": str(index), "ReceiptHandle": receipt_handle}
+                for index, receipt_handle in enumerate(processed)
+            ],
+        )
+
+    app.add_metric("Failed", MetricUnit.Count, len(messages) - len(processed))
+    app.add_metric(
+        "PeakRss",
+        MetricUnit.Megabytes,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024,
+    )
+    publish_metrics()
+
+
+def main() -> None:
+    # Outside Lambda nothing attaches a handler to the root logger
+    logging.basicConfig(level=logging.INFO)
+    signal.signal(signal.SIGTERM, stop)
+
+    with ThreadPoolExecutor(max_workers=app.BATCH_WORKERS) as executor:
+        while running:
+            messages = sqs_client.receive_message(
+                QueueUrl=QUEUE_URL,
+                MaxNumberOfMessages=BATCH_SIZE,
+                WaitTimeSeconds=20,
+            ).get("Messages", [])
+            if messages:
+                process_batch(executor, messages)
+
+
+if __name__ == "__main__":
+    main()
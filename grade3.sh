@@ -8,8 +8,8 @@ pushd cdk
 cdk synth
 popd
 
-git clone https://github.com/infracourse/assignment3-autograder autograder
+# Rules are cloned once and reused, so later runs work offline
+RULES_DIR=.autograder/assignment3-autograder
+[ -d "$RULES_DIR" ] || git clone https://github.com/infracourse/assignment3-autograder "$RULES_DIR"
 
-opa eval -b autograder/rules/ -i <(jq -s 'reduce .[] as $item ({}; .Resources += $item.Resources) | del(.Resources.CDKMetadata)' cdk/cdk.out/yoctogram-network-stack.template.json cdk/cdk.out/yoctogram-data-stack.template.json cdk/cdk.out/yoctogram-compute-stack.template.json) -f json 'data.rules.main' | jq -r .result[].expressions[].value.violations[]
-
-rm -rf autograder
\ No newline at end of file
+(cd cdk && python3 -m cdk.policy_check --rules "../$RULES_DIR/rules")
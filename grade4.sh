@@ -10,10 +10,10 @@ pushd cdk
 cdk synth
 popd
 
-git clone https://github.com/infracourse/assignment4-autograder autograder
+# Rules are cloned once and reused, so later runs work offline
+RULES_DIR=.autograder/assignment4-autograder
+[ -d "$RULES_DIR" ] || git clone https://github.com/infracourse/assignment4-autograder "$RULES_DIR"
 
-opa eval -b autograder/rules/ -i <(jq -s 'reduce .[] as $item ({}; .Resources += $item.Resources) | del(.Resources.CDKMetadata)' cdk/cdk.out/yoctogram-network-stack.template.json cdk/cdk.out/yoctogram-data-stack.template.json cdk/cdk.out/yoctogram-compute-stack.template.json) -f json 'data.rules.main' | jq -r .result[].expressions[].value.violations[]
+(cd cdk && python3 -m cdk.policy_check --rules "../$RULES_DIR/rules")
 
-python3 autograder/grade_action.py $1
-
-rm -rf autograder
+python3 "$RULES_DIR/grade_action.py" $1